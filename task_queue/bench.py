@@ -0,0 +1,212 @@
+from enum import Enum
+from time import perf_counter, time
+from uuid import uuid4
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from server import Journal, Queue, QueueStorage, SnapshotFormat, Task
+
+
+class BaselineTask:
+    """
+        Task layout of the original server: object with __dict__, uuid string and Enum state.
+    """
+
+    class State(Enum):
+        INIT = 1,
+        EXECUTING = 2
+
+    def __init__(self, id_, data):
+        self._id = id_
+        self._data = data
+        self._state = BaselineTask.State.INIT
+        self._time = None
+
+    def run(self):
+        self._state = BaselineTask.State.EXECUTING
+        self._time = time()
+
+
+def measure(func, count):
+    timer = perf_counter()
+    for _ in range(count):
+        func()
+    return (perf_counter() - timer) / count
+
+
+def bench_queue_ops(size, samples):
+    queue = Queue(timeout=300)
+    ids = [queue.add_task('x') for _ in range(size)]
+
+    result = {}
+    result['ADD'] = measure(lambda: queue.add_task('x'), samples)
+    result['IN'] = measure(lambda: queue.in_task(ids[size // 2]), samples)
+
+    # GET и ACK берем парами из середины заполненной очереди
+    taken = []
+    result['GET'] = measure(lambda: taken.append(queue.get_task()[0]), samples)
+    result['ACK'] = measure(lambda: queue.ack_task(taken.pop()), samples)
+    return result
+
+
+def bench_get_in_flight(size, samples):
+    queue = Queue(timeout=300)
+    for _ in range(size):
+        queue.add_task('x')
+        queue.get_task()
+    for _ in range(samples):
+        queue.add_task('x')
+    return measure(queue.get_task, samples)
+
+
+def bench_snapshot(size):
+    storage = QueueStorage()
+    for index in range(size):
+        storage.add_task(str(index % 100), b'x' * 16)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'snapshot')
+        timer = perf_counter()
+        with open(file_path, 'wb') as file:
+            SnapshotFormat.dump(storage, file)
+        dump_time = perf_counter() - timer
+
+        timer = perf_counter()
+        storage = SnapshotFormat.load(file_path)
+        load_time = perf_counter() - timer
+
+        timer = perf_counter()
+        storage.in_task('0', '')
+        first_queue_time = perf_counter() - timer
+    return dump_time, load_time, first_queue_time
+
+
+def bench_batch(size, batch):
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('single', 'batch'):
+            storage = QueueStorage()
+            storage.set_timeout(300)
+            journal = Journal(directory, len(result), fsync=('never', 0))
+            storage.set_journal(journal)
+            datas = [b'x' * 16] * batch
+
+            timer = perf_counter()
+            for _ in range(size // batch):
+                if mode == 'single':
+                    ids = [storage.add_task('q', data) for data in datas]
+                    tasks = [storage.get_task('q') for _ in datas]
+                    for task in tasks:
+                        storage.ack_task('q', task[0])
+                else:
+                    ids = storage.add_tasks('q', datas)
+                    tasks = storage.get_tasks('q', batch)
+                    storage.ack_tasks('q', [task[0] for task in tasks])
+            result[mode] = size / (perf_counter() - timer)
+            journal.close()
+    return result
+
+
+def bench_memory_layout(size, make_task):
+    gc.collect()
+    tracemalloc.start()
+    # Задания в простом списке, как в очереди исходного сервера; половина выдана
+    task_list = [make_task(index) for index in range(1, size + 1)]
+    for task in task_list[:size // 2]:
+        task.run()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / size
+
+
+def bench_memory(size):
+    gc.collect()
+    tracemalloc.start()
+    storage = QueueStorage()
+    for _ in range(size):
+        storage.add_task('q', b'')
+    # Половина заданий выдана и лежит в куче таймаутов
+    storage.get_tasks('q', size // 2)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / size
+
+
+def print_table(title, columns, rows):
+    print(title)
+    print(''.join('{:>12}'.format(column) for column in columns))
+    for row in rows:
+        print(''.join('{:>12}'.format(cell) for cell in row))
+    print()
+
+
+def run_queue_ops(sizes, samples):
+    rows = []
+    for size in sizes:
+        result = bench_queue_ops(size, samples)
+        rows.append([size] + ['{:.2f}us'.format(result[op] * 1e6)
+                              for op in ('ADD', 'GET', 'ACK', 'IN')])
+    print_table('Queue operation latency', ['tasks', 'ADD', 'GET', 'ACK', 'IN'], rows)
+
+
+def run_get_in_flight(sizes, samples):
+    rows = [[size, '{:.2f}us'.format(bench_get_in_flight(size, samples) * 1e6)]
+            for size in sizes]
+    print_table('GET latency behind in-flight tasks', ['in-flight', 'GET'], rows)
+
+
+def run_snapshot(sizes):
+    rows = [[size] + ['{:.3f}s'.format(value) for value in bench_snapshot(size)]
+            for size in sizes]
+    print_table('Snapshot of 100 queues', ['tasks', 'dump', 'load', '1st queue'], rows)
+
+
+def run_batch(sizes, batch=100):
+    rows = []
+    for size in sizes:
+        result = bench_batch(size, batch)
+        rows.append([size] + ['{:.0f}/s'.format(result[mode]) for mode in ('single', 'batch')])
+    print_table('ADD+GET+ACK throughput with journal, batch of {}'.format(batch),
+                ['tasks', 'single', 'batch'], rows)
+
+
+def run_memory(sizes):
+    rows = []
+    for size in sizes:
+        before = bench_memory_layout(size, lambda index: BaselineTask(str(uuid4()), b''))
+        after = bench_memory_layout(size, lambda index: Task(index, b''))
+        rows.append([size] + ['{:.0f}'.format(value) for value in (before, after, bench_memory(size))])
+    # storage - вместе с индексом по id и кучами очереди, которых у исходного сервера не было
+    print_table('Memory per task, empty payload, bytes', ['tasks', 'before', 'after', 'storage'], rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Task queue benchmarks')
+    parser.add_argument(
+        '-s',
+        action="store",
+        dest="sizes",
+        type=int,
+        nargs='+',
+        default=[1000, 10000, 100000, 1000000],
+        help='Queue sizes to measure')
+    parser.add_argument(
+        '-n',
+        action="store",
+        dest="samples",
+        type=int,
+        default=1000,
+        help='Operations per measurement')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    run_queue_ops(ARGS.sizes, ARGS.samples)
+    run_get_in_flight(ARGS.sizes, ARGS.samples)
+    run_snapshot(ARGS.sizes)
+    run_batch(ARGS.sizes)
+    run_memory(ARGS.sizes)
@@ -0,0 +1,365 @@
+from collections import deque, namedtuple
+import asyncio
+import inspect
+import json
+
+
+Task = namedtuple('Task', ['id', 'data'])
+
+
+class ClientException(Exception):
+    pass
+
+
+class QueueFullException(ClientException):
+    pass
+
+
+class ReadOnlyException(ClientException):
+    pass
+
+
+class Connection:
+    """
+        One pipelined STREAM connection to the server.
+
+        Requests are written without waiting for earlier replies, replies
+        come back in request order and resolve the pending futures.
+    """
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._writer = None
+        self._reading = None
+        self._pending = deque()
+        # Сколько запросов ждут задание (GET с ожиданием) и задерживают ответы за ними
+        self.blocking = 0
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def closed(self):
+        return self._writer is None or self._writer.is_closing()
+
+    async def open(self):
+        reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        self._writer.write(b'STREAM\n')
+        await Connection._read_frame(reader)
+        self._reading = asyncio.ensure_future(self._read(reader))
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._reading
+
+    async def request(self, parts, blocking=False):
+        if self.closed:
+            raise ConnectionError('Connection to the server is lost')
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(future)
+        self._writer.writelines(parts)
+        self._writer.write(b'\n')
+        if blocking:
+            self.blocking += 1
+            try:
+                return await future
+            finally:
+                self.blocking -= 1
+        return await future
+
+    async def _read(self, reader):
+        try:
+            while True:
+                body = await Connection._read_frame(reader)
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(body)
+        except (asyncio.IncompleteReadError, ValueError, OSError):
+            pass
+
+        self._writer.close()
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError('Connection to the server is lost'))
+
+    @staticmethod
+    async def _read_frame(reader):
+        length = int(await reader.readuntil(b'\n'))
+        return await reader.readexactly(length)
+
+
+class ConnectionPool:
+    """
+        Up to size connections opened on demand.
+
+        A request goes to the connection with the fewest replies outstanding,
+        preferring connections not held by a waiting GET.
+    """
+
+    def __init__(self, host, port, size):
+        self._host = host
+        self._port = port
+        self._size = size
+        self._connections = []
+        self._opening = set()
+
+    async def request(self, parts, blocking=False):
+        connection = await self._acquire()
+        return await connection.request(parts, blocking)
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await connection.close()
+
+    async def _acquire(self):
+        self._connections = [connection for connection in self._connections if not connection.closed]
+        idle = [connection for connection in self._connections if not connection.pending]
+        if idle:
+            return idle[0]
+        if len(self._connections) + len(self._opening) < self._size:
+            return await self._open()
+        if not self._connections:
+            # Все соединения еще открываются: ждем первое из них
+            await asyncio.wait(self._opening, return_when=asyncio.FIRST_COMPLETED)
+            return await self._acquire()
+        return min(self._connections, key=lambda connection: (connection.blocking, connection.pending))
+
+    async def _open(self):
+        connection = Connection(self._host, self._port)
+        opening = asyncio.ensure_future(connection.open())
+        self._opening.add(opening)
+        try:
+            await opening
+        finally:
+            self._opening.discard(opening)
+        self._connections.append(connection)
+        return connection
+
+
+class OneShotPool:
+    """
+        A new connection for every request, as the server's one-shot mode
+        expects: the command is sent in one write, the reply ends with EOF.
+    """
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+
+    async def request(self, parts, blocking=False):
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        writer.write(b''.join(parts))
+        try:
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def close(self):
+        pass
+
+
+class AsyncClient:
+    """
+        asyncio client of the task queue server.
+
+        With routing (the default), commands for a queue go straight to the
+        port of the worker that owns it (server started with -w), which is
+        asked once per queue with SHARD. Without stream every command opens
+        its own connection.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5555, pool_size=4, routing=True, stream=True):
+        self._host = host
+        self._pool_size = pool_size
+        self._stream = stream
+        self._pool = self._new_pool(port)
+        self._routing = routing
+        self._pools = {port: self._pool}
+        self._owners = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        for pool in self._pools.values():
+            await pool.close()
+
+    async def request(self, *parts, blocking=False, queue=None):
+        parts = [AsyncClient._encode(part) for part in parts]
+        pool = self._pool if queue is None or not self._routing else await self._owner(queue)
+        response = await pool.request(parts, blocking)
+        if response == b'ERROR':
+            raise ClientException('Server rejected {!r}'.format(parts[0].split(b' ', 1)[0]))
+        if response == b'FULL':
+            raise QueueFullException('Queue is full')
+        if response == b'READONLY':
+            raise ReadOnlyException('Server is a read-only replica')
+        return response
+
+    async def _owner(self, queue):
+        pool = self._owners.get(queue)
+        if pool is None:
+            port = await self._pool.request([b'SHARD ', queue.encode()])
+            if port in (b'NONE', b'ERROR'):
+                # Сервер без отдельных портов воркеров сам пересылает команды владельцу
+                pool = self._pool
+            else:
+                port = int(port)
+                if port not in self._pools:
+                    self._pools[port] = self._new_pool(port)
+                pool = self._pools[port]
+            self._owners[queue] = pool
+        return pool
+
+    def _new_pool(self, port):
+        if self._stream:
+            return ConnectionPool(self._host, port, self._pool_size)
+        return OneShotPool(self._host, port)
+
+    async def add(self, queue, data, priority=None, delay=None):
+        header = b'ADD %s%s %d ' % (queue.encode(), AsyncClient._options(priority, delay), len(data))
+        return (await self.request(header, data, queue=queue)).decode()
+
+    async def get(self, queue, wait=None):
+        if wait is None:
+            response = await self.request(b'GET ', queue, queue=queue)
+        else:
+            response = await self.request(b'GET %s %r' % (queue.encode(), float(wait)),
+                                          blocking=True, queue=queue)
+        if response == b'NONE':
+            return None
+        return AsyncClient._parse_tasks(response, 1)[0]
+
+    async def ack(self, queue, task_id):
+        return await self.request(b'ACK %s %s' % (queue.encode(), task_id.encode()), queue=queue) == b'YES'
+
+    async def contains(self, queue, task_id):
+        return await self.request(b'IN %s %s' % (queue.encode(), task_id.encode()), queue=queue) == b'YES'
+
+    async def save(self):
+        await self.request(b'SAVE')
+
+    async def stats(self):
+        return json.loads((await self.request(b'STATS')).decode())
+
+    async def add_many(self, queue, items, priority=None, delay=None):
+        items = [bytes(item) for item in items]
+        if not items:
+            return []
+        body = b' '.join(b'%d %s' % (len(item), item) for item in items)
+        header = b'MADD %s%s %d ' % (queue.encode(), AsyncClient._options(priority, delay), len(body))
+        return (await self.request(header, body, queue=queue)).decode().split(' ')
+
+    async def get_many(self, queue, count):
+        response = await self.request(b'MGET %s %d' % (queue.encode(), count), queue=queue)
+        if response == b'NONE':
+            return []
+        count, response = response.split(b' ', 1)
+        return AsyncClient._parse_tasks(response, int(count))
+
+    async def ack_many(self, queue, task_ids):
+        if not task_ids:
+            return []
+        response = await self.request(b'MACK %s %s' % (queue.encode(), ' '.join(task_ids).encode()),
+                                      queue=queue)
+        return [answer == b'YES' for answer in response.split(b' ')]
+
+    async def consume(self, queue, handler, concurrency=16, wait=1, limit=None):
+        """
+            Passes tasks of the queue to handler, at most concurrency at once.
+
+            A task is acknowledged when handler returns; if it raises, the task
+            is left to the server timeout and delivered again. Runs until
+            cancelled or until limit tasks have been handled.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        running = set()
+        taken = 0
+        try:
+            while limit is None or taken < limit:
+                await semaphore.acquire()
+                task = await self.get(queue, wait)
+                if task is None:
+                    semaphore.release()
+                    continue
+                taken += 1
+                job = asyncio.ensure_future(self._handle(queue, handler, task, semaphore))
+                running.add(job)
+                job.add_done_callback(running.discard)
+            if running:
+                await asyncio.wait(running)
+        finally:
+            for job in running:
+                job.cancel()
+
+    async def _handle(self, queue, handler, task, semaphore):
+        try:
+            result = handler(task)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            return
+        finally:
+            semaphore.release()
+        await self.ack(queue, task.id)
+
+    @staticmethod
+    def _encode(part):
+        return part.encode() if isinstance(part, str) else part
+
+    @staticmethod
+    def _options(priority, delay):
+        options = b''
+        if priority is not None:
+            options += b' priority=%d' % priority
+        if delay is not None:
+            options += b' delay=%r' % float(delay)
+        return options
+
+    @staticmethod
+    def _parse_tasks(response, count):
+        tasks = []
+        for _ in range(count):
+            task_id, length, response = response.split(b' ', 2)
+            length = int(length)
+            tasks.append(Task(task_id.decode(), response[:length]))
+            response = response[length + 1:]
+        return tasks
+
+
+class Client:
+    """
+        Blocking wrapper around AsyncClient with its own event loop.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5555, pool_size=1, routing=True):
+        self._loop = asyncio.new_event_loop()
+        self._client = AsyncClient(host, port, pool_size, routing)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        if not inspect.iscoroutinefunction(method):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self._loop.run_until_complete(method(*args, **kwargs))
+        return call
+
+    def close(self):
+        if not self._loop.is_closed():
+            self._loop.run_until_complete(self._client.close())
+            self._loop.close()
@@ -0,0 +1,328 @@
+from collections import defaultdict
+from math import ceil
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from client import AsyncClient, ClientException
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.empty_gets = 0
+
+    def merge(self, other):
+        for name, values in other.latencies.items():
+            self.latencies[name].extend(values)
+        for name, errors in other.errors.items():
+            self.errors[name] += errors
+        self.empty_gets += other.empty_gets
+
+    async def measure(self, name, request):
+        timer = perf_counter()
+        try:
+            response = await request
+        except ClientException:
+            self.errors[name] += 1
+            response = None
+        self.latencies[name].append(perf_counter() - timer)
+        return response
+
+    @staticmethod
+    def percentile(values, fraction):
+        return values[max(ceil(fraction * len(values)) - 1, 0)]
+
+    def report(self, duration):
+        result = {}
+        for name, values in sorted(self.latencies.items()):
+            values.sort()
+            result[name] = {
+                'count': len(values),
+                'errors': self.errors[name],
+                'throughput': len(values) / duration,
+                'mean_ms': sum(values) / len(values) * 1e3,
+                'p50_ms': self.percentile(values, 0.5) * 1e3,
+                'p99_ms': self.percentile(values, 0.99) * 1e3,
+                'p999_ms': self.percentile(values, 0.999) * 1e3,
+            }
+        return result
+
+
+def new_client(args, port=None):
+    # Каждый продюсер и консьюмер - отдельное соединение с каждым нужным ему воркером
+    return AsyncClient(args.ip, args.port if port is None else port, pool_size=1,
+                       routing=args.routing, stream=args.stream)
+
+
+async def producer(args, index, stats, deadline):
+    payload = b'x' * args.payload
+    sent = 0
+    async with new_client(args) as client:
+        while perf_counter() < deadline:
+            queue = 'q{}'.format((index + sent) % args.queues)
+            await stats.measure('ADD', client.add(queue, payload))
+            sent += 1
+
+
+async def consumer(args, index, stats, deadline):
+    received = 0
+    async with new_client(args) as client:
+        while perf_counter() < deadline:
+            queue = 'q{}'.format((index + received) % args.queues)
+            received += 1
+            task = await stats.measure('GET', client.get(queue))
+            if task is None:
+                stats.empty_gets += 1
+                await asyncio.sleep(0.001)
+                continue
+            await stats.measure('ACK', client.ack(queue, task.id))
+
+
+async def lag_probe(args, stats, deadline):
+    # Задержка репликации: от ADD на основном сервере до появления задания на реплике
+    async with new_client(args) as primary, new_client(args, args.replica_port) as replica:
+        while perf_counter() < deadline:
+            timer = perf_counter()
+            task_id = await primary.add('lag', b'x')
+            while not await replica.contains('lag', task_id):
+                if perf_counter() >= deadline:
+                    break
+                await asyncio.sleep(0.0005)
+            else:
+                stats.latencies['LAG'].append(perf_counter() - timer)
+            await asyncio.sleep(0.01)
+
+
+async def run_load(args, job):
+    stats = Stats()
+    deadline = perf_counter() + args.duration
+    first_producer = job * args.producers
+    first_consumer = job * args.consumers
+    probes = [lag_probe(args, stats, deadline)] if args.replica_port is not None and job == 0 else []
+    await asyncio.gather(
+        *[producer(args, first_producer + index, stats, deadline) for index in range(args.producers)],
+        *[consumer(args, first_consumer + index, stats, deadline) for index in range(args.consumers)],
+        *probes)
+    return stats
+
+
+def run_job(job_args):
+    args, job = job_args
+    return asyncio.run(run_load(args, job))
+
+
+def run_jobs(args):
+    # Один процесс клиента сам упирается в ядро, поэтому нагрузку дают несколько процессов
+    started = perf_counter()
+    if args.jobs == 1:
+        results = [run_job((args, 0))]
+    else:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = pool.map(run_job, [(args, job) for job in range(args.jobs)])
+    duration = perf_counter() - started
+
+    stats = Stats()
+    for result in results:
+        stats.merge(result)
+    return {
+        'config': dict((key, value) for key, value in vars(args).items() if key != 'output'),
+        'duration': duration,
+        'empty_gets': stats.empty_gets,
+        'commands': stats.report(duration),
+    }
+
+
+def spawn_server(args, directory, port=None, options=()):
+    port = args.port if port is None else port
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+               '-p', str(port), '-i', args.ip, '-c', directory, '-w', str(args.workers),
+               '-u', args.event_loop, *options]
+    server = subprocess.Popen(command, cwd=directory)
+    for _ in range(100):
+        try:
+            # Пустое соединение сервер просто закроет
+            socket.create_connection((args.ip, port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server
+
+
+def spawn_servers(args, directory):
+    if args.replica_port is None:
+        return [spawn_server(args, directory)]
+
+    primary = spawn_server(args, directory, options=('-l', str(args.replication_port)))
+    replica_directory = os.path.join(directory, 'replica')
+    os.mkdir(replica_directory)
+    replica = spawn_server(args, replica_directory, args.replica_port,
+                           ('-R', '{}:{}'.format(args.ip, args.replication_port)))
+    return [primary, replica]
+
+
+def stop_servers(servers):
+    # Процессорное время серверов: дочерние процессы учитываются после wait
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    for server in servers:
+        server.terminate()
+        server.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+
+
+def print_report(result):
+    print('{:>6}{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}'.format(
+        'cmd', 'count', 'errors', 'ops/s', 'p50 ms', 'p99 ms', 'p999 ms'))
+    for name, stats in result['commands'].items():
+        print('{:>6}{:>10}{:>8}{:>12.0f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            name, stats['count'], stats['errors'], stats['throughput'],
+            stats['p50_ms'], stats['p99_ms'], stats['p999_ms']))
+    print('empty GETs: {}'.format(result['empty_gets']))
+    if 'server_cpu_us' in result:
+        print('server CPU per request: {:.1f} us'.format(result['server_cpu_us']))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Load generator for the task queue server')
+    parser.add_argument(
+        '-p',
+        action="store",
+        dest="port",
+        type=int,
+        default=5555,
+        help='Server port')
+    parser.add_argument(
+        '-i',
+        action="store",
+        dest="ip",
+        type=str,
+        default='127.0.0.1',
+        help='Server ip adress')
+    parser.add_argument(
+        '-P',
+        action="store",
+        dest="producers",
+        type=int,
+        default=4,
+        help='Number of producer connections')
+    parser.add_argument(
+        '-C',
+        action="store",
+        dest="consumers",
+        type=int,
+        default=4,
+        help='Number of consumer connections')
+    parser.add_argument(
+        '-s',
+        action="store",
+        dest="payload",
+        type=int,
+        default=100,
+        help='Task data length in bytes')
+    parser.add_argument(
+        '-q',
+        action="store",
+        dest="queues",
+        type=int,
+        default=1,
+        help='Number of queues')
+    parser.add_argument(
+        '-d',
+        action="store",
+        dest="duration",
+        type=float,
+        default=10,
+        help='Duration of the run in seconds')
+    parser.add_argument(
+        '-j',
+        action="store",
+        dest="jobs",
+        type=int,
+        default=1,
+        help='Client processes, each with its own producers and consumers')
+    parser.add_argument(
+        '--one-shot',
+        action="store_false",
+        dest="stream",
+        help='Open a new connection per command instead of STREAM mode')
+    parser.add_argument(
+        '--spawn',
+        action="store_true",
+        dest="spawn",
+        help='Start a server in a temporary directory for the run')
+    parser.add_argument(
+        '-w',
+        action="store",
+        dest="workers",
+        type=int,
+        default=1,
+        help='Worker processes of the spawned server')
+    parser.add_argument(
+        '-u',
+        action="store",
+        dest="event_loop",
+        choices=['auto', 'asyncio', 'uvloop'],
+        default='auto',
+        help='Event loop of the spawned server')
+    parser.add_argument(
+        '-R',
+        action="store",
+        dest="replica_port",
+        type=int,
+        default=None,
+        help='Port of a replica of the server, enables the LAG probe')
+    parser.add_argument(
+        '-L',
+        action="store",
+        dest="replication_port",
+        type=int,
+        default=5557,
+        help='Replication port of the spawned primary when -R is given')
+    parser.add_argument(
+        '--no-routing',
+        action="store_false",
+        dest="routing",
+        help='Send every command to the shared port and let the server forward it to the owner worker')
+    parser.add_argument(
+        '-o',
+        action="store",
+        dest="output",
+        type=str,
+        default=None,
+        help='Write results as JSON to this file')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    with tempfile.TemporaryDirectory() as directory:
+        servers = spawn_servers(args, directory) if args.spawn else []
+        try:
+            result = run_jobs(args)
+        finally:
+            server_cpu = stop_servers(servers)
+
+    if servers:
+        requests = sum(stats['count'] for name, stats in result['commands'].items() if name != 'LAG')
+        result['server_cpu_us'] = server_cpu / max(requests, 1) * 1e6
+
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    return result
+
+
+if __name__ == '__main__':
+    main()
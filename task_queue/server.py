@@ -1,239 +1,2521 @@
 
-from uuid import uuid4
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from bisect import bisect
+from heapq import heapify, heappush, heappop
+from itertools import count
 from enum import Enum
-from time import time
+from time import time, perf_counter
 import argparse
 import asyncio
+import hashlib
+import json
+import math
 import os
+import mmap
 import pickle
+import re
+import signal
+import struct
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 class ParserException(Exception):
     pass
 
-class LengthException(Exception):
-    pass
 
-class Task:
-    class State(Enum):
-        INIT = 1,
-        EXECUTING = 2
+class QueueFullException(Exception):
+    pass
+
+
+class CommandParser:
+    """
+        Incremental parser of the command stream.
+
+        Header is read once, payload bytes are counted against the declared
+        length and copied straight into a preallocated buffer.
+    """
+
+    PAYLOAD_COMMANDS = (b'ADD', b'MADD')
+    PAYLOAD_HEADER = re.compile(rb'\s*(ADD|MADD)[ \t]+\S+(?:[ \t]+[a-z]+=\S*)*[ \t]+(\d+)[ \t\n]')
+    # Начало заголовка, из которого еще может получиться PAYLOAD_HEADER
+    PAYLOAD_PREFIX = re.compile(rb'\s*(?:ADD|MADD)(?:[ \t]+\S+(?:[ \t]+[a-z]+=\S*)*(?:[ \t]+(?:\d+|[a-z]+))?)?[ \t]*')
+
+    def __init__(self, max_payload, max_header=1024):
+        self._max_payload = max_payload
+        self._max_header = max_header
+        self._header = bytearray()
+        self._args = None
+        self._payload = None
+        self._filled = 0
+        self._skip = 0
+        self.broken = False
+
+    def feed(self, data):
+        view = memoryview(data)
+        commands = []
+        pos = 0
+        while pos < len(view) and not self.broken:
+            if self._skip:
+                skipped = min(self._skip, len(view) - pos)
+                self._skip -= skipped
+                pos += skipped
+            elif self._payload is not None:
+                pos = self._read_payload(view, pos, commands)
+            else:
+                pos = self._read_header(data, pos, commands)
+        return commands
+
+    def flush(self):
+        if self._payload is not None or self._skip:
+            return []
+
+        header = bytes(self._header)
+        first = header.split()[:1]
+        if not first or first[0] in self.PAYLOAD_COMMANDS and self.PAYLOAD_PREFIX.fullmatch(header):
+            return []
+
+        self._header.clear()
+        return [self._command(header)]
+
+    def pending(self):
+        return bool(self._payload is not None or self._skip or self._header.strip())
+
+    def _read_header(self, data, pos, commands):
+        newline = data.find(b'\n', pos)
+        end = len(data) if newline < 0 else newline + 1
+        prior_length = len(self._header)
+        stop = min(end, pos + self._max_header - prior_length)
+        self._header += data[pos:stop]
+
+        match = self.PAYLOAD_HEADER.match(self._header)
+        if match:
+            header_end = pos + match.end() - prior_length
+            self._start_payload(match, commands)
+            return header_end
+
+        if self._header.endswith(b'\n'):
+            header = bytes(self._header)
+            self._header.clear()
+            if header.strip():
+                commands.append(self._command(header))
+        elif len(self._header) >= self._max_header:
+            self.broken = True
+            commands.append(None)
+        return stop
+
+    def _start_payload(self, match, commands):
+        args = self._decode(bytes(self._header[:match.end()]))
+        length = int(match.group(2))
+        self._header.clear()
+        if args is None or length > self._max_payload:
+            # Тело слишком большое: пропускаем его, не сохраняя в памяти
+            self._skip = length
+            commands.append(None)
+            return
+
+        self._args = args
+        self._payload = bytearray(length)
+        self._filled = 0
+        if not length:
+            self._finish_payload(commands)
+
+    def _read_payload(self, view, pos, commands):
+        count = min(len(self._payload) - self._filled, len(view) - pos)
+        self._payload[self._filled:self._filled + count] = view[pos:pos + count]
+        self._filled += count
+        if self._filled == len(self._payload):
+            self._finish_payload(commands)
+        return pos + count
+
+    def _finish_payload(self, commands):
+        commands.append((self._args, self._payload))
+        self._args = None
+        self._payload = None
+
+    @staticmethod
+    def _decode(header):
+        try:
+            return header.decode().split()
+        except UnicodeDecodeError:
+            return None
+
+    @staticmethod
+    def _command(header):
+        args = CommandParser._decode(header)
+        return None if args is None else (args, None)
+
+class Task:
+    class State(Enum):
+        # Нужен только чтобы читать pickle-дампы старых версий
+        INIT = 1,
+        EXECUTING = 2
+
+    INIT = 0
+    EXECUTING = 1
+
+    ID_FORMAT = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+    __slots__ = ('_id', '_data', '_seq', '_state', '_time', '_priority', '_not_before', '_attempts')
+
+    def __init__(self, id_, data, seq=None, priority=0, not_before=None, attempts=0):
+        self._id = id_
+        self._data = data
+        self._seq = id_ if seq is None else seq
+        self._state = Task.INIT
+        self._time = None
+        self._priority = priority
+        self._not_before = not_before
+        self._attempts = attempts
+
+    @staticmethod
+    def format_id(id_):
+        # Сразу в байтах: идентификатор уходит в ответ без промежуточной строки
+        digits = b'%032x' % id_
+        return b'-'.join((digits[:8], digits[8:12], digits[12:16], digits[16:20], digits[20:]))
+
+    @staticmethod
+    def parse_id(text):
+        if not Task.ID_FORMAT.fullmatch(text):
+            return None
+        return int(text.replace('-', ''), 16)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def seq(self):
+        return self._seq
+
+    @seq.setter
+    def seq(self, seq):
+        self._seq = seq
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def not_before(self):
+        return self._not_before
+
+    @property
+    def attempts(self):
+        return self._attempts
+
+    @attempts.setter
+    def attempts(self, attempts):
+        self._attempts = attempts
+
+    def run(self, now=None):
+        self._state = Task.EXECUTING
+        self._time = time() if now is None else now
+        self._attempts += 1
+
+    def moved(self, attempts):
+        # Перенесенное в другую очередь задание - новый объект: записи в кучах старой очереди устаревают
+        return Task(self._id, self._data, self._seq, self._priority, None, attempts)
+
+    def reset(self):
+        self._state = Task.INIT
+
+    def __setstate__(self, state):
+        # Старые дампы хранили uuid строкой, содержимое строкой и состояние в Enum
+        data = state['_data']
+        self._id = Task.parse_id(state['_id'])
+        self._data = data.encode() if isinstance(data, str) else data
+        self._seq = state.get('_seq', 0)
+        self._state = Task.EXECUTING if state['_state'] == Task.State.EXECUTING else Task.INIT
+        self._time = state['_time']
+        self._priority = 0
+        self._not_before = None
+        self._attempts = 0
+
+    def expired(self, timeout, now=None):
+        if now is None:
+            now = time()
+        return self._state == Task.EXECUTING and now - self._time > timeout
+
+
+class Queue:
+    def __init__(self, timeout, next_id=None, release=None):
+        self._tasks = dict()
+        self._ready = deque()
+        self._redelivery = []
+        self._prioritized = []
+        self._delayed = []
+        self._in_flight = []
+        self._timeout = timeout
+        self._next_id = count(1).__next__ if next_id is None else next_id
+        self._release = release
+        self._stale = 0
+        # Записи подтвержденных заданий, которые еще лежат в _in_flight
+        self._stale_in_flight = 0
+        self._dead = []
+        self.max_attempts = 0
+        self.maxlen = 0
+        self.idle = None
+        self.added = 0
+        self.delivered = 0
+        self.acked = 0
+        self.redelivered = 0
+        self.dead_lettered = 0
+
+    def add_task(self, data, priority=0, not_before=None):
+        id_ = self._next_id()
+        self._push_task(Task(id_, data, priority=priority, not_before=not_before))
+        self.added += 1
+        return id_
+
+    def add_tasks(self, datas, priority=0, not_before=None):
+        return [self.add_task(data, priority, not_before) for data in datas]
+
+    def get_task(self, now=None):
+        tasks = self.get_tasks(1, now)
+        return tasks[0] if tasks else None
+
+    def get_tasks(self, count, now=None):
+        if now is None:
+            now = time()
+        self.expire(now)
+
+        tasks = []
+        while len(tasks) < count:
+            task = self._pop_ready()
+            if task is None:
+                break
+            if self._tasks.get(task.id) is not task:
+                # Задание забрали из очереди командой REQUEUE
+                self._stale -= 1
+                continue
+            task.run(now)
+            heappush(self._in_flight, (task.time + self._timeout, task.seq, task))
+            tasks.append((task.id, len(task.data), task.data))
+        self.delivered += len(tasks)
+        return tasks
+
+    def ack_tasks(self, ids):
+        now = time()
+        return [self.ack_task(id_, now) for id_ in ids]
+
+    def ack_task(self, id_, now=None):
+        task = self._tasks.get(id_)
+        if task is None:
+            return False
+
+        if task.state != Task.EXECUTING or task.expired(self._timeout, now):
+            return False
+
+        # Запись в _in_flight удалится лениво, когда истечет ее срок или когда таких записей
+        # станет больше половины кучи
+        del self._tasks[id_]
+        if self._release is not None:
+            self._release(task.data)
+        self.acked += 1
+        self._stale_in_flight += 1
+        if self._stale_in_flight * 2 > len(self._in_flight):
+            self._compact_in_flight()
+        return True
+
+    def _compact_in_flight(self):
+        self._in_flight = [entry for entry in self._in_flight if self._tasks.get(entry[2].id) is entry[2]]
+        heapify(self._in_flight)
+        self._stale_in_flight = 0
+
+    def in_task(self, id_):
+        return id_ in self._tasks
+
+    def push(self, task):
+        self._tasks[task.id] = task
+        self._requeue(task)
+
+    def remove(self, id_, now=None):
+        if now is None:
+            now = time()
+        self._release_delayed(now)
+        task = self._tasks.get(id_)
+        if task is None or task.state != Task.INIT:
+            return None
+        if task.not_before is not None and task.not_before > now:
+            return None
+
+        # Запись в очереди готовых заданий пропустится при выдаче
+        del self._tasks[id_]
+        self._stale += 1
+        return task
+
+    def peek(self, count):
+        return [task for _, task in zip(range(count), self._tasks.values())]
+
+    def take_dead(self):
+        dead, self._dead = self._dead, []
+        return dead
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    def set_timeout(self, timeout):
+        # Сроки уже выданных заданий пересчитываются под новый таймаут
+        self._timeout = timeout
+        self._in_flight = [(task.time + timeout, task.seq, task) for _, _, task in self._in_flight
+                           if self._tasks.get(task.id) is task and task.state == Task.EXECUTING]
+        heapify(self._in_flight)
+        self._stale_in_flight = 0
+
+    def full(self, count=1):
+        return bool(self.maxlen) and len(self._tasks) + count > self.maxlen
+
+    def tasks(self):
+        return self._tasks.values()
+
+    def expire(self, now):
+        self._requeue_expired(now)
+        self._release_delayed(now)
+
+    def stats(self, now=None):
+        self.expire(time() if now is None else now)
+        ready = len(self._ready) + len(self._redelivery) + len(self._prioritized) - self._stale
+        return {
+            'tasks': len(self._tasks),
+            'ready': ready,
+            'delayed': len(self._delayed),
+            'in_flight': len(self._tasks) - ready - len(self._delayed),
+            'added': self.added,
+            'delivered': self.delivered,
+            'acked': self.acked,
+            'redelivered': self.redelivered,
+            'dead_lettered': self.dead_lettered,
+        }
+
+    def set_id_source(self, next_id):
+        self._next_id = next_id
+
+    def set_release(self, release):
+        self._release = release
+
+    @classmethod
+    def restore(cls, timeout, tasks, next_id, release=None):
+        queue = cls(timeout, next_id, release)
+        for task in tasks:
+            queue._push_task(task)
+        return queue
+
+    def restore_task(self, id_, data, priority=0, not_before=None):
+        self._tasks[id_] = Task(id_, data, priority=priority, not_before=not_before)
+
+    def restore_run(self, id_, now):
+        task = self._tasks.get(id_)
+        if task is not None:
+            task.run(now)
+
+    def restore_remove(self, id_):
+        return self._tasks.pop(id_, None)
+
+    def restore_push(self, task):
+        self._tasks[task.id] = task
+
+    def restore_ack(self, id_):
+        task = self._tasks.pop(id_, None)
+        if task is not None and self._release is not None:
+            self._release(task.data)
+
+    def rebuild(self):
+        self._stale = 0
+        self._ready.clear()
+        self._redelivery = []
+        self._prioritized = []
+        self._delayed = []
+        self._in_flight = []
+        self._stale_in_flight = 0
+        for task in self._tasks.values():
+            self._schedule(task)
+
+    def _push_task(self, task):
+        self._tasks[task.id] = task
+        self._schedule(task)
+
+    def _schedule(self, task):
+        if task.state == Task.EXECUTING:
+            heappush(self._in_flight, (task.time + self._timeout, task.seq, task))
+        elif task.not_before is not None and task.not_before > time():
+            heappush(self._delayed, (task.not_before, task.seq, task))
+        elif task.priority or self._ready and task.seq < self._ready[-1].seq:
+            # Очередь готовых заданий должна оставаться упорядоченной по seq
+            self._requeue(task)
+        else:
+            self._ready.append(task)
+
+    def _requeue(self, task):
+        # Вернувшееся задание встает на место по своему порядковому номеру
+        if task.priority:
+            heappush(self._prioritized, (-task.priority, task.seq, task))
+        else:
+            heappush(self._redelivery, (task.seq, task))
+
+    def _requeue_expired(self, now):
+        while self._in_flight and self._in_flight[0][0] < now:
+            _, seq, task = heappop(self._in_flight)
+            if self._tasks.get(task.id) is not task:
+                self._stale_in_flight = max(self._stale_in_flight - 1, 0)
+                continue
+            if self.max_attempts and task.attempts >= self.max_attempts:
+                # Задание исчерпало попытки: его заберет очередь <queue>.dlq
+                del self._tasks[task.id]
+                self._dead.append(task)
+                self.dead_lettered += 1
+                continue
+            task.reset()
+            self._requeue(task)
+            self.redelivered += 1
+
+    def _release_delayed(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            task = heappop(self._delayed)[2]
+            if self._tasks.get(task.id) is task:
+                self._requeue(task)
+
+    def _pop_ready(self):
+        if self._prioritized and self._prioritized[0][:2] < self._fifo_key():
+            return heappop(self._prioritized)[2]
+        if self._redelivery and (not self._ready or self._redelivery[0][0] < self._ready[0].seq):
+            return heappop(self._redelivery)[1]
+        if self._ready:
+            return self._ready.popleft()
+        return None
+
+    def _fifo_key(self):
+        # Задания без приоритета упорядочены ключом (0, seq)
+        if self._redelivery and (not self._ready or self._redelivery[0][0] < self._ready[0].seq):
+            return (0, self._redelivery[0][0])
+        if self._ready:
+            return (0, self._ready[0].seq)
+        return (float('inf'), 0)
+
+    def next_deadline(self):
+        deadlines = []
+        if self._in_flight:
+            deadlines.append(self._in_flight[0][0])
+        if self._delayed:
+            deadlines.append(self._delayed[0][0])
+        return min(deadlines) if deadlines else None
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __setstate__(self, state):
+        # Pickle-дамп исходной версии сервера хранил задания списком
+        self.__init__(state['_timeout'])
+        for seq, task in enumerate(state['_task_list']):
+            task.seq = seq
+            self._push_task(task)
+
+
+class LazyQueue:
+    """
+        Queue that is still a block of an mmap-ed snapshot.
+
+        It is parsed into a Queue on first access. Until then a new snapshot
+        copies the block as is.
+    """
+
+    __slots__ = ('buffer', 'offset', 'length', 'timeout', 'count', 'maxlen', 'idle')
+
+    def __init__(self, buffer, offset, length, timeout, count, maxlen=0, idle=None):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self.timeout = timeout
+        self.count = count
+        self.maxlen = maxlen
+        self.idle = idle
+
+    def raw(self):
+        return self.buffer[self.offset:self.offset + self.length]
+
+    def __len__(self):
+        return self.count
+
+    def load(self, next_id, spill=None):
+        if spill is None:
+            queue = Queue.restore(self.timeout, SnapshotFormat.read_tasks(self), next_id)
+        else:
+            queue = Queue.restore(self.timeout, SnapshotFormat.read_tasks(self, spill), next_id,
+                                  spill.release)
+        queue.maxlen = self.maxlen
+        queue.idle = self.idle
+        return queue
+
+
+class SnapshotFormat:
+    """
+        Binary snapshot of QueueStorage.
+
+        File header, then for every queue a header with the byte length of
+        its task block and the task records themselves. Records are written
+        one by one, so dump streams and never holds the whole file in memory.
+    """
+
+    MAGIC = b'TQSNAP'
+    VERSION = 1
+
+    version_header = struct.Struct('>6sH')
+    file_header = struct.Struct('>6sHQdQI')
+    queue_header = struct.Struct('>HdQQQd')
+    task_header = struct.Struct('>16sQBdidII')
+
+    @classmethod
+    def dump(cls, storage, file):
+        queues = storage.queues()
+        configs = storage.configs()
+        file.write(cls.file_header.pack(cls.MAGIC, cls.VERSION, storage.generation,
+                                        storage.timeout, storage.last_id, len(queues) + len(configs)))
+        for name, (timeout, maxlen, idle) in configs.items():
+            # Настройки удаленной очереди сохраняются как пустая очередь
+            name = name.encode()
+            idle = float('nan') if idle is None else idle
+            file.write(cls.queue_header.pack(len(name), timeout, 0, 0, maxlen, idle))
+            file.write(name)
+        for name, queue in queues.items():
+            name = name.encode()
+            idle = float('nan') if queue.idle is None else queue.idle
+            if isinstance(queue, LazyQueue):
+                # Еще не разобранная очередь: блок заданий копируется как есть
+                file.write(cls.queue_header.pack(len(name), queue.timeout, queue.count, queue.length,
+                                                 queue.maxlen, idle))
+                file.write(name)
+                file.write(queue.raw())
+            else:
+                cls._dump_queue(file, name, queue)
+
+    @classmethod
+    def _dump_queue(cls, file, name, queue):
+        header_pos = file.tell()
+        file.write(cls.queue_header.pack(len(name), 0, 0, 0, 0, 0) + name)
+        length = 0
+        for task in queue.tasks():
+            task_time = float('nan') if task.time is None else task.time
+            not_before = float('nan') if task.not_before is None else task.not_before
+            record = cls.task_header.pack(task.id.to_bytes(16, 'big'), task.seq, task.state, task_time,
+                                          task.priority, not_before, task.attempts, len(task.data))
+            file.write(record)
+            file.write(task.data)
+            length += len(record) + len(task.data)
+
+        end_pos = file.tell()
+        file.seek(header_pos)
+        idle = float('nan') if queue.idle is None else queue.idle
+        file.write(cls.queue_header.pack(len(name), queue.timeout, len(queue), length,
+                                         queue.maxlen, idle))
+        file.seek(end_pos)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'rb') as file:
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                # Снимки старых версий сервера были pickle-дампом
+                file.seek(0)
+                return pickle.load(file)
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _, version = cls.version_header.unpack_from(buffer, 0)
+        if version != cls.VERSION:
+            raise ValueError('Unsupported snapshot version {}'.format(version))
+
+        _, _, generation, timeout, last_id, queue_count = cls.file_header.unpack_from(buffer, 0)
+        storage = QueueStorage(last_id)
+        storage.generation = generation
+        storage.set_timeout(timeout)
+        pos = cls.file_header.size
+        for _ in range(queue_count):
+            name_length, queue_timeout, task_count, length, maxlen, idle = \
+                cls.queue_header.unpack_from(buffer, pos)
+            pos += cls.queue_header.size
+            name = bytes(buffer[pos:pos + name_length]).decode()
+            pos += name_length
+            storage.add_lazy_queue(name, LazyQueue(buffer, pos, length, queue_timeout, task_count, maxlen,
+                                                   None if math.isnan(idle) else idle))
+            pos += length
+        return storage
+
+    @classmethod
+    def read_tasks(cls, lazy_queue, spill=None):
+        buffer = lazy_queue.buffer
+        view = memoryview(buffer)
+        pos = lazy_queue.offset
+        for _ in range(lazy_queue.count):
+            id_, seq, state, task_time, priority, not_before, attempts, data_length = \
+                cls.task_header.unpack_from(buffer, pos)
+            pos += cls.task_header.size
+            if spill is not None and spill.spills(data_length):
+                # Большие данные копируются из снимка в сегмент, минуя кучу
+                data = spill.store(view[pos:pos + data_length])
+            else:
+                data = buffer[pos:pos + data_length]
+            task = Task(int.from_bytes(id_, 'big'), data, seq,
+                        priority, None if math.isnan(not_before) else not_before)
+            pos += data_length
+            if state == Task.EXECUTING:
+                task.run(task_time)
+            task.attempts = attempts
+            yield task
+
+
+class Journal:
+    """
+        Append-only log of ADD/GET/ACK operations.
+
+        Journal files are numbered by generation: a snapshot stores the
+        generation that was started right after it, so on restore only the
+        journals of that generation and later ones are replayed.
+    """
+
+    ADD = 1
+    GET = 2
+    ACK = 3
+    DEAD = 4
+    REQUEUE = 5
+    CONFIG = 6
+    DROP = 7
+
+    file_prefix = '.task_journal.'
+    header = struct.Struct('>BI')
+    field = struct.Struct('>I')
+    timestamp = struct.Struct('>d')
+    options = struct.Struct('>id')
+    config = struct.Struct('>dQd')
+
+    def __init__(self, path, generation, fsync=('ms', 100)):
+        self._path = path
+        self._fsync_mode, self._fsync_value = fsync
+        self._unsynced = 0
+        self._sync_handle = None
+        self._batch = None
+        self.listeners = []
+        self._open(generation)
+
+    @classmethod
+    def file_name(cls, path, generation):
+        return os.path.join(path, '{}{}'.format(cls.file_prefix, generation))
+
+    @classmethod
+    def generations(cls, path):
+        result = []
+        for name in os.listdir(path):
+            suffix = name[len(cls.file_prefix):]
+            if name.startswith(cls.file_prefix) and suffix.isdigit():
+                result.append(int(suffix))
+        return sorted(result)
+
+    @classmethod
+    def remove_before(cls, path, generation):
+        for old_generation in cls.generations(path):
+            if old_generation < generation:
+                os.remove(cls.file_name(path, old_generation))
+
+    @classmethod
+    def read(cls, path, generation):
+        with open(cls.file_name(path, generation), 'rb') as file:
+            data = file.read()
+
+        pos = 0
+        while pos + cls.header.size <= len(data):
+            kind, length = cls.header.unpack_from(data, pos)
+            pos += cls.header.size
+            if pos + length > len(data):
+                # Запись оборвана на середине: сервер упал во время записи
+                return
+            yield kind, cls.unpack_fields(data[pos:pos + length])
+            pos += length
+
+    def log_add(self, queue_name, id_, data, priority=0, not_before=None):
+        fields = [queue_name.encode(), id_.to_bytes(16, 'big'), data]
+        if priority or not_before is not None:
+            # Поле параметров пишется только для заданий с приоритетом или отсрочкой
+            fields.append(Journal.options.pack(
+                priority, float('nan') if not_before is None else not_before))
+        self._append(Journal.ADD, *fields)
+
+    def log_get(self, queue_name, id_, now):
+        self._append(Journal.GET, queue_name.encode(), id_.to_bytes(16, 'big'),
+                     Journal.timestamp.pack(now))
+
+    def log_ack(self, queue_name, id_):
+        self._append(Journal.ACK, queue_name.encode(), id_.to_bytes(16, 'big'))
+
+    def log_dead(self, queue_name, id_):
+        self._append(Journal.DEAD, queue_name.encode(), id_.to_bytes(16, 'big'))
+
+    def log_requeue(self, queue_name, id_):
+        self._append(Journal.REQUEUE, queue_name.encode(), id_.to_bytes(16, 'big'))
+
+    def log_config(self, queue_name, timeout, maxlen, idle):
+        self._append(Journal.CONFIG, queue_name.encode(), Journal.config.pack(
+            timeout, maxlen, float('nan') if idle is None else idle))
+
+    def log_drop(self, queue_name):
+        self._append(Journal.DROP, queue_name.encode())
+
+    @staticmethod
+    def decode_options(fields):
+        if not fields:
+            return 0, None
+        priority, not_before = Journal.options.unpack(fields[0])
+        return priority, None if math.isnan(not_before) else not_before
+
+    @staticmethod
+    def decode_id(field):
+        return int.from_bytes(field, 'big')
+
+    @contextmanager
+    def batch(self):
+        # Записи пачки уходят в файл одним вызовом write
+        self._batch = []
+        try:
+            yield
+        finally:
+            records, self._batch = self._batch, None
+            if records:
+                self._write(b''.join(records), len(records))
+
+    def rotate(self):
+        self.close()
+        self._open(self.generation + 1)
+        return self.generation
+
+    def sync(self):
+        self._sync_handle = None
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+
+    def close(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+        self.sync()
+        os.close(self._fd)
+
+    def _open(self, generation):
+        self.generation = generation
+        self._fd = os.open(Journal.file_name(self._path, generation),
+                           os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self._fd).st_size
+
+    def _append(self, kind, *fields):
+        body = b''.join(Journal.field.pack(len(field)) + field for field in fields)
+        record = Journal.header.pack(kind, len(body)) + body
+        if self._batch is not None:
+            self._batch.append(record)
+        else:
+            self._write(record, 1)
+
+    def append_raw(self, data, count=1):
+        self._write(data, count)
+
+    def _write(self, data, count):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        self.size += len(data)
+        self._unsynced += count
+        self._schedule_sync()
+        for listener in self.listeners:
+            listener(data)
+
+    def _schedule_sync(self):
+        if self._fsync_mode == 'always':
+            self.sync()
+        elif self._fsync_mode == 'ops' and self._unsynced >= self._fsync_value:
+            self.sync()
+        elif self._fsync_mode == 'ms' and self._sync_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.sync()
+            else:
+                self._sync_handle = loop.call_later(self._fsync_value / 1000, self.sync)
+
+    @classmethod
+    def unpack_fields(cls, body):
+        fields = []
+        pos = 0
+        while pos < len(body):
+            length, = cls.field.unpack_from(body, pos)
+            pos += cls.field.size
+            fields.append(body[pos:pos + length])
+            pos += length
+        return fields
+
+
+class SpillSegment:
+    __slots__ = ('file_name', 'buffer', 'used', 'live')
+
+    def __init__(self, file_name, size):
+        self.file_name = file_name
+        fd = os.open(file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.buffer = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.used = 0
+        self.live = 0
+
+
+class SpillStore:
+    """
+        Append-only memory-mapped segment files for large task payloads.
+
+        A spilled payload is a memoryview into a segment, so the heap holds
+        only the view itself. The pages are file-backed and the kernel can
+        evict them. A segment is removed once all its tasks are acknowledged.
+    """
+
+    file_prefix = '.task_spill.'
+    segment_size = 64 * 2 ** 20
+
+    def __init__(self, path, threshold):
+        self._path = path
+        self._threshold = threshold
+        self._segments = dict()
+        self._active = None
+        self._number = 0
+        # Сегменты прошлого запуска не нужны: данные заданий есть в снимке и журнале
+        for name in os.listdir(path):
+            if name.startswith(SpillStore.file_prefix):
+                os.remove(os.path.join(path, name))
+
+    def spills(self, length):
+        return self._threshold is not None and length >= self._threshold
+
+    def wrap(self, data):
+        return self.store(data) if self.spills(len(data)) else data
+
+    def store(self, data):
+        length = len(data)
+        segment = self._active
+        if segment is None or segment.used + length > len(segment.buffer):
+            if segment is not None and not segment.live:
+                self._remove(segment)
+            segment = self._active = self._open(max(SpillStore.segment_size, length))
+
+        start = segment.used
+        segment.buffer[start:start + length] = data
+        segment.used += length
+        segment.live += length
+        return memoryview(segment.buffer)[start:start + length]
+
+    def release(self, data):
+        if not isinstance(data, memoryview):
+            return
+        segment = self._segments.get(id(data.obj))
+        if segment is None:
+            return
+
+        segment.live -= len(data)
+        if not segment.live:
+            # Активный сегмент тоже удаляется: отданные клиентам view могут еще читать его
+            if segment is self._active:
+                self._active = None
+            self._remove(segment)
+
+    def _open(self, size):
+        self._number += 1
+        segment = SpillSegment(
+            os.path.join(self._path, '{}{}'.format(SpillStore.file_prefix, self._number)), size)
+        self._segments[id(segment.buffer)] = segment
+        return segment
+
+    def _remove(self, segment):
+        del self._segments[id(segment.buffer)]
+        try:
+            segment.buffer.close()
+        except BufferError:
+            # Отображение освободится вместе с последним view на него
+            pass
+        os.remove(segment.file_name)
+
+
+class Snapshot:
+    """
+        Writes QueueStorage snapshots in a forked child process.
+
+        The child gets a copy-on-write view of the storage frozen at the
+        moment of fork, so the event loop keeps serving clients while the
+        snapshot is written to a temp file and renamed into place.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, path, file_name):
+        self._path = path
+        self.file_path = os.path.join(path, file_name)
+        self._tmp_path = self.file_path + '.tmp'
+        self._pid = None
+        self._generation = None
+        self._waiters = []
+        self._next = None
+        self.last_size = None
+        self.generation = None
+        self.failed = False
+
+    @property
+    def running(self):
+        return self._pid is not None
+
+    def save(self, storage, journal):
+        future = asyncio.get_event_loop().create_future()
+        if not self.running:
+            self._waiters.append(future)
+            self._start(storage, journal)
+        elif self._next is None:
+            # Идущий снимок уже не содержит последних изменений
+            self._next = (storage, journal, [future])
+        else:
+            self._next[2].append(future)
+        return future
+
+    def status(self):
+        if self.running:
+            size = os.path.getsize(self._tmp_path) if os.path.exists(self._tmp_path) else 0
+            return b'RUNNING %d' % size
+        if self.failed:
+            return b'FAILED'
+        if self.last_size is None:
+            return b'IDLE'
+        return b'DONE %d' % self.last_size
+
+    def _start(self, storage, journal):
+        self._generation = journal.rotate()
+        storage.generation = self._generation
+        if not hasattr(os, 'fork'):
+            self._finish(self._write(storage))
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            # Дочерний процесс не должен вернуться в цикл событий с унаследованными сокетами
+            code = 1
+            try:
+                code = 0 if self._write(storage) else 1
+            finally:
+                os._exit(code)
+
+        self._pid = pid
+        asyncio.get_event_loop().call_later(Snapshot.poll_interval, self._poll)
+
+    def _write(self, storage):
+        try:
+            with open(self._tmp_path, 'wb') as file:
+                SnapshotFormat.dump(storage, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self._tmp_path, self.file_path)
+        except OSError:
+            return False
+        return True
+
+    def _poll(self):
+        pid, status = os.waitpid(self._pid, os.WNOHANG)
+        if not pid:
+            asyncio.get_event_loop().call_later(Snapshot.poll_interval, self._poll)
+            return
+
+        self._pid = None
+        self._finish(os.waitstatus_to_exitcode(status) == 0)
+
+    def _finish(self, success):
+        self.failed = not success
+        if success:
+            self.last_size = os.path.getsize(self.file_path)
+            self.generation = self._generation
+            Journal.remove_before(self._path, self._generation)
+
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(success)
+
+        if self._next is not None:
+            storage, journal, self._waiters = self._next
+            self._next = None
+            self._start(storage, journal)
+
+
+class QueueStorage:
+    DEAD_SUFFIX = '.dlq'
+
+    def __init__(self, last_id=0):
+        self.last_id = last_id
+        self.max_attempts = 0
+        self.idle = 0
+        self._queue = dict()
+        self._lazy = dict()
+        self._empty = OrderedDict()
+        # Настройки CONFIG удаленных пустых очередей: возвращаются, когда очередь снова нужна
+        self._configs = dict()
+        self._min_idle = 0
+        self._timeout = 0
+        self._journal = None
+        self._spill = None
+        self._replayed = set()
+        self._waiters = dict()
+        self._timers = dict()
+        self.generation = 0
+
+    def add_task(self, queue_name, data, priority=0, delay=0):
+        queue = self._get_queue(queue_name)
+        if queue.full():
+            raise QueueFullException
+        not_before = time() + delay if delay else None
+        id_ = queue.add_task(self._wrap(data), priority, not_before)
+        self._empty.pop(queue_name, None)
+        if self._journal is not None:
+            self._journal.log_add(queue_name, id_, data, priority, not_before)
+        self._serve_waiters(queue_name)
+        return id_
+
+    def get_task(self, queue_name):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            return None
+
+        now = time()
+        task = queue.get_task(now)
+        self._bury(queue_name, queue)
+        if task is not None and self._journal is not None:
+            self._journal.log_get(queue_name, task[0], now)
+        return task
+
+    def ack_task(self, queue_name, id_):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            return False
+
+        ack_state = queue.ack_task(id_)
+        if ack_state and self._journal is not None:
+            self._journal.log_ack(queue_name, id_)
+        self._track_empty(queue_name, queue)
+        return ack_state
+
+    def add_tasks(self, queue_name, datas, priority=0, delay=0):
+        queue = self._get_queue(queue_name)
+        if queue.full(len(datas)):
+            raise QueueFullException
+        not_before = time() + delay if delay else None
+        ids = queue.add_tasks([self._wrap(data) for data in datas], priority, not_before)
+        self._empty.pop(queue_name, None)
+        if self._journal is not None:
+            with self._journal.batch():
+                for id_, data in zip(ids, datas):
+                    self._journal.log_add(queue_name, id_, data, priority, not_before)
+        self._serve_waiters(queue_name)
+        return ids
+
+    def dead_tasks(self, queue_name, count):
+        queue = self._find_queue(queue_name)
+        if queue is not None:
+            # Истекшие задания переносятся лениво, сначала доводим их до очереди .dlq
+            queue.expire(time())
+            self._bury(queue_name, queue)
+
+        dead_queue = self._find_queue(queue_name + QueueStorage.DEAD_SUFFIX)
+        if dead_queue is None:
+            return 0, []
+        return len(dead_queue), dead_queue.peek(count)
+
+    def requeue_tasks(self, queue_name, ids=None):
+        dead_queue = self._find_queue(queue_name + QueueStorage.DEAD_SUFFIX)
+        if dead_queue is None:
+            return [] if ids is None else [False] * len(ids)
+        if ids is None:
+            ids = [task.id for task in dead_queue.tasks()]
+
+        queue = self._get_queue(queue_name)
+        now = time()
+        states = []
+        for id_ in ids:
+            task = dead_queue.remove(id_, now)
+            states.append(task is not None)
+            if task is None:
+                continue
+            queue.push(task.moved(0))
+            if self._journal is not None:
+                self._journal.log_requeue(queue_name, id_)
+        self._track_empty(queue_name + QueueStorage.DEAD_SUFFIX, dead_queue)
+        self._track_empty(queue_name, queue)
+        self._serve_waiters(queue_name)
+        return states
+
+    def _bury(self, queue_name, queue):
+        dead = queue.take_dead()
+        if not dead:
+            return
+
+        dead_queue_name = queue_name + QueueStorage.DEAD_SUFFIX
+        dead_queue = self._get_queue(dead_queue_name)
+        for task in dead:
+            dead_queue.push(task.moved(task.attempts))
+            if self._journal is not None:
+                self._journal.log_dead(queue_name, task.id)
+        self._track_empty(queue_name, queue)
+        self._track_empty(dead_queue_name, dead_queue)
+        self._serve_waiters(dead_queue_name)
+
+    def configure(self, queue_name, timeout=None, maxlen=None, idle=None):
+        queue = self._get_queue(queue_name)
+        if timeout is not None:
+            queue.set_timeout(timeout)
+        if maxlen is not None:
+            queue.maxlen = maxlen
+        if idle is not None:
+            queue.idle = idle
+            if idle:
+                self._min_idle = min(self._min_idle, idle) if self._min_idle else idle
+        if self._journal is not None:
+            self._journal.log_config(queue_name, queue.timeout, queue.maxlen, queue.idle)
+        self._track_empty(queue_name, queue)
+        return queue
+
+    def config(self, queue_name):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            timeout, maxlen, idle = self._configs.get(queue_name, (self._timeout, 0, None))
+        else:
+            timeout, maxlen, idle = queue.timeout, queue.maxlen, queue.idle
+        return timeout, maxlen, self.idle if idle is None else idle
+
+    def configs(self):
+        return dict(self._configs)
+
+    def _track_empty(self, queue_name, queue):
+        # Пустые очереди упорядочены по времени, с которого они пусты
+        if len(queue):
+            self._empty.pop(queue_name, None)
+        elif queue_name not in self._empty:
+            self._empty[queue_name] = time()
+
+    def track_empty(self):
+        for queue_name, queue in self.queues().items():
+            self._track_empty(queue_name, queue)
+
+    def reclaim_idle(self, now=None):
+        if now is None:
+            now = time()
+        idles = [idle for idle in (self.idle, self._min_idle) if idle]
+        if not idles:
+            return
+        min_idle = min(idles)
+
+        reclaimed = []
+        stale = []
+        for queue_name, since in self._empty.items():
+            if now - since < min_idle:
+                # Дальше очереди опустели еще позже
+                break
+            queue = self._queue.get(queue_name)
+            if queue is None:
+                queue = self._lazy.get(queue_name)
+            if queue is None:
+                # Очередь уже удалена, осталась только отметка о пустоте
+                stale.append(queue_name)
+                continue
+            idle = self.idle if queue.idle is None else queue.idle
+            if idle and now - since >= idle and not self._waiters.get(queue_name):
+                reclaimed.append(queue_name)
+
+        for queue_name in stale:
+            del self._empty[queue_name]
+        for queue_name in reclaimed:
+            self._drop(queue_name)
+            if self._journal is not None:
+                self._journal.log_drop(queue_name)
+
+    def _drop(self, queue_name):
+        self._empty.pop(queue_name, None)
+        queue = self._queue.pop(queue_name, None)
+        if queue is None:
+            queue = self._lazy.pop(queue_name, None)
+        if queue is not None and (queue.timeout != self._timeout or queue.maxlen or queue.idle is not None):
+            self._configs[queue_name] = (queue.timeout, queue.maxlen, queue.idle)
+        self._waiters.pop(queue_name, None)
+        timer = self._timers.pop(queue_name, None)
+        if timer is not None:
+            timer[1].cancel()
+
+    def wait_task(self, queue_name, timeout):
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        waiters = self._waiters.setdefault(queue_name, deque())
+        while waiters and waiters[0].done():
+            waiters.popleft()
+        waiters.append(waiter)
+
+        handle = loop.call_later(timeout, self._expire_waiter, waiter)
+        waiter.add_done_callback(lambda _: handle.cancel())
+        self._schedule_redelivery(queue_name)
+        return waiter
+
+    @staticmethod
+    def _expire_waiter(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _serve_waiters(self, queue_name):
+        waiters = self._waiters.get(queue_name)
+        while waiters:
+            if waiters[0].done():
+                waiters.popleft()
+                continue
+            task = self.get_task(queue_name)
+            if task is None:
+                break
+            waiters.popleft().set_result(task)
+
+        if waiters:
+            self._schedule_redelivery(queue_name)
+        else:
+            self._waiters.pop(queue_name, None)
+
+    def _schedule_redelivery(self, queue_name):
+        # Ждущих клиентов будит истечение таймаута выданного задания или отсрочки нового
+        queue = self._find_queue(queue_name)
+        deadline = None if queue is None else queue.next_deadline()
+        if deadline is None:
+            return
+
+        timer = self._timers.get(queue_name)
+        if timer is not None:
+            if timer[0] <= deadline:
+                return
+            timer[1].cancel()
+
+        delay = max(deadline - time(), 0) + 0.001
+        self._timers[queue_name] = (deadline, asyncio.get_event_loop().call_later(
+            delay, self._redelivery_timer, queue_name))
+
+    def _redelivery_timer(self, queue_name):
+        del self._timers[queue_name]
+        self._serve_waiters(queue_name)
+
+    def get_tasks(self, queue_name, count):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            return []
+
+        now = time()
+        tasks = queue.get_tasks(count, now)
+        self._bury(queue_name, queue)
+        if self._journal is not None:
+            with self._journal.batch():
+                for task in tasks:
+                    self._journal.log_get(queue_name, task[0], now)
+        return tasks
+
+    def ack_tasks(self, queue_name, ids):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            return [False] * len(ids)
+
+        ack_states = queue.ack_tasks(ids)
+        if self._journal is not None:
+            with self._journal.batch():
+                for id_, ack_state in zip(ids, ack_states):
+                    if ack_state:
+                        self._journal.log_ack(queue_name, id_)
+        self._track_empty(queue_name, queue)
+        return ack_states
+
+    def in_task(self, queue_name, id_):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            return False
+        return queue.in_task(id_)
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    def queues(self):
+        queues = dict(self._lazy)
+        queues.update(self._queue)
+        return queues
+
+    def stats(self, readonly=False):
+        if readonly:
+            # На реплике очереди не перестраиваются до повышения: известно только число заданий
+            return dict((queue_name, {'tasks': len(queue)}) for queue_name, queue in self.queues().items())
+
+        now = time()
+        for queue_name, queue in list(self._queue.items()):
+            queue.expire(now)
+            self._bury(queue_name, queue)
+        stats = dict((queue_name, queue.stats(now)) for queue_name, queue in self._queue.items())
+        for queue_name, lazy_queue in self._lazy.items():
+            # Очередь из снимка не разбирается ради статистики
+            stats[queue_name] = {'tasks': lazy_queue.count}
+        return stats
+
+    def add_lazy_queue(self, queue_name, lazy_queue):
+        self._lazy[queue_name] = lazy_queue
+
+    def _find_queue(self, queue_name):
+        queue = self._queue.get(queue_name)
+        if queue is None and queue_name in self._lazy:
+            queue = self._queue[queue_name] = self._lazy.pop(queue_name).load(
+                self._next_id, self._spill)
+            self._limit_attempts(queue_name, queue)
+        return queue
+
+    def _get_queue(self, queue_name):
+        queue = self._find_queue(queue_name)
+        if queue is None:
+            release = None if self._spill is None else self._spill.release
+            timeout, maxlen, idle = self._configs.pop(queue_name, (self._timeout, 0, None))
+            queue = self._queue[queue_name] = Queue(timeout, self._next_id, release)
+            queue.maxlen = maxlen
+            queue.idle = idle
+            self._limit_attempts(queue_name, queue)
+        return queue
+
+    def _limit_attempts(self, queue_name, queue):
+        # Из очереди мертвых заданий задания никуда не переносятся
+        if not queue_name.endswith(QueueStorage.DEAD_SUFFIX):
+            queue.max_attempts = self.max_attempts
+
+    def set_idle(self, idle):
+        self.idle = idle
+
+    def set_max_attempts(self, max_attempts):
+        self.max_attempts = max_attempts
+        for queue_name, queue in self._queue.items():
+            self._limit_attempts(queue_name, queue)
+
+    def _wrap(self, data):
+        return data if self._spill is None else self._spill.wrap(data)
+
+    def _next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def set_timeout(self, timeout):
+        self._timeout = timeout
+
+    def set_journal(self, journal):
+        self._journal = journal
+
+    def set_spill(self, spill):
+        self._spill = spill
+        for queue in self._queue.values():
+            queue.set_release(spill.release)
+
+    def replay(self, kind, fields):
+        queue_name = fields[0].decode()
+        if kind == Journal.DROP:
+            self._drop(queue_name)
+            return
+
+        queue = self._get_queue(queue_name)
+        self._replayed.add(queue)
+        if kind == Journal.CONFIG:
+            timeout, maxlen, idle = Journal.config.unpack(fields[1])
+            queue.set_timeout(timeout)
+            queue.maxlen = maxlen
+            queue.idle = None if math.isnan(idle) else idle
+            return
+
+        id_ = Journal.decode_id(fields[1])
+
+        if kind == Journal.ADD:
+            if id_ < 2 ** 64:
+                self.last_id = max(self.last_id, id_)
+            queue.restore_task(id_, self._wrap(fields[2]), *Journal.decode_options(fields[3:]))
+        elif kind == Journal.GET:
+            queue.restore_run(id_, Journal.timestamp.unpack(fields[2])[0])
+        elif kind == Journal.ACK:
+            queue.restore_ack(id_)
+        elif kind in (Journal.DEAD, Journal.REQUEUE):
+            dead_queue = self._get_queue(fields[0].decode() + QueueStorage.DEAD_SUFFIX)
+            self._replayed.add(dead_queue)
+            if kind == Journal.DEAD:
+                task = queue.restore_remove(id_)
+                if task is not None:
+                    dead_queue.restore_push(task.moved(task.attempts))
+            else:
+                task = dead_queue.restore_remove(id_)
+                if task is not None:
+                    queue.restore_push(task.moved(0))
+
+    def finish_replay(self):
+        for queue in self._replayed:
+            queue.rebuild()
+        self._replayed.clear()
+
+    def __setstate__(self, state):
+        # Снимок старого формата в pickle
+        state.setdefault('_lazy', dict())
+        state.setdefault('_waiters', dict())
+        state.setdefault('_timers', dict())
+        state.setdefault('_journal', None)
+        state.setdefault('_spill', None)
+        state.setdefault('max_attempts', 0)
+        state.setdefault('idle', 0)
+        state.setdefault('_empty', OrderedDict())
+        state.setdefault('_configs', dict())
+        state.setdefault('_min_idle', 0)
+        state.setdefault('_replayed', set())
+        state.setdefault('generation', 0)
+        self.__dict__.update(state)
+        self.last_id = max([len(queue) for queue in self._queue.values()] + [0])
+        for queue in self._queue.values():
+            queue.set_id_source(self._next_id)
+
+
+class Metrics:
+    """
+        Per-command counters and latency histograms.
+
+        Buckets are fixed, so recording a command costs the same regardless of
+        how many were recorded before.
+    """
+
+    COMMANDS = ('ADD', 'GET', 'ACK', 'IN', 'MADD', 'MGET', 'MACK', 'DLQ', 'REQUEUE', 'CONFIG',
+                'SAVE', 'STATS', 'PROMOTE', 'OTHER')
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.started = time()
+        self._commands = dict((name, {
+            'count': 0,
+            'errors': 0,
+            'seconds': 0.0,
+            'buckets': [0] * (len(Metrics.BUCKETS) + 1),
+        }) for name in Metrics.COMMANDS)
+
+    def observe(self, name, started, resp):
+        if not isinstance(resp, asyncio.Future):
+            self.record(name, perf_counter() - started, resp)
+            return
+
+        def done(future):
+            # Отложенный ответ учитывается, когда он готов
+            if not future.cancelled():
+                self.record(name, perf_counter() - started, future.result())
+        resp.add_done_callback(done)
 
-    def __init__(self, id_, data):
-        self._id = id_
-        self._data = data
-        self._state = Task.State.INIT
-        self._time = None
+    def record(self, name, duration, resp):
+        command = self._commands.get(name) or self._commands['OTHER']
+        command['count'] += 1
+        command['seconds'] += duration
+        command['buckets'][bisect(Metrics.BUCKETS, duration)] += 1
+        if resp == b'ERROR':
+            command['errors'] += 1
 
-    @property
-    def id(self):
-        return self._id
+    def stats(self, storage, readonly=False):
+        uptime = time() - self.started
+        commands = dict()
+        for name, command in self._commands.items():
+            commands[name] = dict(command, rate=command['count'] / uptime)
+        return {'uptime': uptime, 'commands': commands, 'queues': storage.stats(readonly)}
 
-    @property
-    def state(self):
-        return self._state
+    @staticmethod
+    def merge(results):
+        merged = {'uptime': 0.0, 'commands': dict(), 'queues': dict()}
+        for stats in results:
+            merged['uptime'] = max(merged['uptime'], stats['uptime'])
+            merged['queues'].update(stats['queues'])
+            for name, command in stats['commands'].items():
+                total = merged['commands'].get(name)
+                if total is None:
+                    merged['commands'][name] = dict(command, buckets=list(command['buckets']))
+                    continue
+                for key in ('count', 'errors', 'seconds', 'rate'):
+                    total[key] += command[key]
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], command['buckets'])]
+        return merged
 
-    @property
-    def data(self):
-        return self._data
+    @staticmethod
+    def prometheus(stats):
+        lines = [
+            '# TYPE task_queue_uptime_seconds gauge',
+            'task_queue_uptime_seconds {}'.format(stats['uptime']),
+            '# TYPE task_queue_command_errors_total counter',
+        ]
+        for name, command in stats['commands'].items():
+            lines.append('task_queue_command_errors_total{{command="{}"}} {}'.format(
+                name, command['errors']))
 
-    def run(self):
-        self._state = Task.State.EXECUTING
-        self._time = time()
+        lines.append('# TYPE task_queue_command_duration_seconds histogram')
+        for name, command in stats['commands'].items():
+            total = 0
+            for bound, value in zip(Metrics.BUCKETS + ('+Inf',), command['buckets']):
+                total += value
+                lines.append('task_queue_command_duration_seconds_bucket{{command="{}",le="{}"}} {}'.format(
+                    name, bound, total))
+            lines.append('task_queue_command_duration_seconds_sum{{command="{}"}} {}'.format(
+                name, command['seconds']))
+            lines.append('task_queue_command_duration_seconds_count{{command="{}"}} {}'.format(
+                name, command['count']))
 
-    def update(self, timeout):
-        if self._state == Task.State.EXECUTING and time() - self._time > timeout:
-            self._state = Task.State.INIT
+        for key, kind in (('tasks', 'gauge'), ('ready', 'gauge'), ('delayed', 'gauge'),
+                          ('in_flight', 'gauge'),
+                          ('added', 'counter'), ('delivered', 'counter'),
+                          ('acked', 'counter'), ('redelivered', 'counter'),
+                          ('dead_lettered', 'counter')):
+            metric = 'task_queue_{}{}'.format(key, '_total' if kind == 'counter' else '')
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for queue_name, queue in sorted(stats['queues'].items()):
+                if key in queue:
+                    label = queue_name.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append('{}{{queue="{}"}} {}'.format(metric, label, queue[key]))
+        return ('\n'.join(lines) + '\n').encode()
 
 
-class Queue:
-    def __init__(self, timeout):
-        self._task_list = list()
-        self._timeout = timeout
+class HashRing:
+    """
+        Consistent hashing of queue names onto shards.
 
-    def add_task(self, data):
-        id_ = str(uuid4())
-        self._task_list.append(Task(id_, data))
-        return id_
+        md5 is used instead of hash(): every worker process must place a
+        queue on the same shard.
+    """
 
-    def get_task(self):
-        for task in self._task_list:
-            task.update(self._timeout)
-            if task.state == Task.State.INIT:
-                task.run()
-                return (task.id, len(task.data), task.data)
-        return None
+    def __init__(self, shards, replicas=64):
+        points = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                points.append((HashRing._hash('{}-{}'.format(shard, replica)), shard))
+        points.sort()
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
 
-    def ack_task(self, id_):
-        for index, task in enumerate(self._task_list):
-            if task.id == id_:
-                task.update(self._timeout)
-                if task.state == Task.State.EXECUTING:
-                    del self._task_list[index]
-                    return True
-                else:
-                    return False
-        return False
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
 
-    def in_task(self, id_):
-        for task in self._task_list:
-            if task.id == id_:
-                return True
-        return False
+    def find(self, queue_name):
+        # Очередь мертвых заданий живет на том же шарде, что и исходная
+        if queue_name.endswith(QueueStorage.DEAD_SUFFIX):
+            queue_name = queue_name[:-len(QueueStorage.DEAD_SUFFIX)]
+        index = bisect(self._keys, HashRing._hash(queue_name)) % len(self._keys)
+        return self._shards[index]
 
 
-class QueueStorage:
-    def __init__(self):
-        self._queue = dict()
-        self._timeout = 0
+class ShardLink:
+    """
+        Persistent pipelined STREAM connection to another shard's unix socket.
+    """
 
-    def add_task(self, queue_name, data):
-        if queue_name not in self._queue:
-            self._queue[queue_name] = Queue(self._timeout)
+    connect_attempts = 20
 
-        return self._queue[queue_name].add_task(data)
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+        self._writer = None
+        self._connecting = None
+        self._pending = deque()
 
-    def get_task(self, queue_name):
-        if queue_name not in self._queue:
-            return None
-        else:
-            return self._queue[queue_name].get_task()
+    async def request(self, data):
+        if self._writer is None:
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._connect())
+            try:
+                await asyncio.shield(self._connecting)
+            except OSError:
+                self._connecting = None
+                return b'ERROR'
 
-    def ack_task(self, queue_name, id_):
-        if queue_name not in self._queue:
-            return False
-        return self._queue[queue_name].ack_task(id_)
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(data)
+        return await future
 
-    def in_task(self, queue_name, id_):
-        if queue_name not in self._queue:
-            return False
-        return self._queue[queue_name].in_task(id_)
+    async def request_once(self, data):
+        # Для долгих команд, чтобы не задерживать остальные ответы общего соединения
+        try:
+            reader, writer = await self._open()
+        except OSError:
+            return b'ERROR'
+        writer.write(b'STREAM\n' + data)
+        try:
+            await ShardLink._read_frame(reader)
+            return await ShardLink._read_frame(reader)
+        except (asyncio.IncompleteReadError, ValueError):
+            return b'ERROR'
+        finally:
+            writer.close()
 
-    def set_timeout(self, timeout):
+    async def _open(self):
+        for _ in range(ShardLink.connect_attempts - 1):
+            try:
+                return await asyncio.open_unix_connection(self._socket_path)
+            except OSError:
+                # Соседний воркер может еще запускаться
+                await asyncio.sleep(0.05)
+        return await asyncio.open_unix_connection(self._socket_path)
+
+    async def _connect(self):
+        reader, writer = await self._open()
+        writer.write(b'STREAM\n')
+        self._pending.append(asyncio.get_event_loop().create_future())
+        self._writer = writer
+        asyncio.ensure_future(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                body = await ShardLink._read_frame(reader)
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(body)
+        except (asyncio.IncompleteReadError, ValueError):
+            pass
+
+        self._writer = None
+        self._connecting = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_result(b'ERROR')
+
+    @staticmethod
+    async def _read_frame(reader):
+        length = int(await reader.readuntil(b'\n'))
+        return await reader.readexactly(length)
+
+
+class ReplicationSource:
+    """
+        Primary side of replication.
+
+        A follower gets a fresh snapshot, the journal written since it and
+        then every journal record as it is written.
+    """
+
+    chunk_size = 2 ** 20
+    max_buffer = 64 * 2 ** 20
+
+    def __init__(self, journal):
+        self._journal = journal
+        self.followers = 0
+
+    async def serve(self, reader, writer):
+        if not await ServerCore.snapshot.save(ServerCore.queue_storage, self._journal):
+            writer.close()
+            return
+
+        # Без await до подписки на журнал: ни одна запись не должна потеряться
+        snapshot = open(ServerCore.snapshot.file_path, 'rb')
+        backlog = []
+        for generation in Journal.generations(ServerCore.path):
+            if generation >= ServerCore.snapshot.generation:
+                with open(Journal.file_name(ServerCore.path, generation), 'rb') as file:
+                    backlog.append(file.read())
+        pending = []
+        listener = pending.append
+        self._journal.listeners.append(listener)
+        self.followers += 1
+
+        try:
+            with snapshot:
+                writer.write(b'%d\n' % os.fstat(snapshot.fileno()).st_size)
+                for chunk in iter(lambda: snapshot.read(ReplicationSource.chunk_size), b''):
+                    writer.write(chunk)
+                    await writer.drain()
+            writer.writelines(backlog)
+            del backlog
+
+            while pending:
+                data, pending[:] = b''.join(pending), []
+                writer.write(data)
+                await writer.drain()
+            self._journal.listeners.remove(listener)
+            listener = self._forward(writer)
+            self._journal.listeners.append(listener)
+            # Реплика ничего не присылает: ждем закрытия соединения
+            await reader.read()
+        except OSError:
+            pass
+        finally:
+            self._journal.listeners.remove(listener)
+            self.followers -= 1
+            writer.close()
+
+    @staticmethod
+    def _forward(writer):
+        def forward(data):
+            if writer.transport.get_write_buffer_size() > ReplicationSource.max_buffer:
+                # Реплика не успевает: она переподключится и получит новый снимок
+                writer.transport.abort()
+            elif not writer.transport.is_closing():
+                writer.write(data)
+        return forward
+
+
+class Replica:
+    """
+        Follower side of replication.
+
+        The received snapshot and records are written to the follower's own
+        snapshot and journal. Records are applied the way a journal is
+        replayed on restore, so queues are rebuilt only on promotion.
+    """
+
+    retry_interval = 1
+    chunk_size = 2 ** 20
+
+    def __init__(self, host, port, fsync, timeout):
+        self.primary = (host, port)
+        self._fsync = fsync
         self._timeout = timeout
+        self._task = None
+        self.connected = False
+        self.applied = 0
+        self.last_applied = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    def stats(self):
+        return {'role': 'replica', 'primary': '{}:{}'.format(*self.primary),
+                'connected': self.connected, 'applied': self.applied,
+                'last_applied': self.last_applied}
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*self.primary)
+            except OSError:
+                await asyncio.sleep(Replica.retry_interval)
+                continue
+
+            try:
+                await self._sync(reader)
+            except (asyncio.IncompleteReadError, ValueError, OSError):
+                pass
+            finally:
+                self.connected = False
+                writer.close()
+            await asyncio.sleep(Replica.retry_interval)
+
+    async def _sync(self, reader):
+        size = int(await reader.readuntil(b'\n'))
+        file_path = os.path.join(ServerCore.path, ServerCore.save_file_name)
+        with open(file_path + '.tmp', 'wb') as file:
+            while size:
+                chunk = await reader.readexactly(min(size, Replica.chunk_size))
+                file.write(chunk)
+                size -= len(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_path + '.tmp', file_path)
+
+        ServerCore.journal.close()
+        Journal.remove_before(ServerCore.path, float('inf'))
+        ServerCore.restore_from_dump(self._fsync, self._timeout)
+        self.connected = True
+
+        while True:
+            header = await reader.readexactly(Journal.header.size)
+            kind, length = Journal.header.unpack(header)
+            body = await reader.readexactly(length)
+            ServerCore.journal.append_raw(header + body)
+            ServerCore.queue_storage.replay(kind, Journal.unpack_fields(body))
+            self.applied += 1
+            self.last_applied = time()
 
 
 class ServerCore(asyncio.Protocol):
     queue_storage = QueueStorage()
     path = "./"
     save_file_name = ".task_save"
+    max_payload = 10 ** 6
+    inline_payload = 1024
+    spill_threshold = 64 * 2 ** 10
+    max_attempts = 0
+    idle = 600
+    reclaim_interval = 1
+    journal = None
+    journal_limit = 64 * 2 ** 20
+    snapshot = None
+    socket_name = ".task_sock"
+    shard = None
+    ring = None
+    links = dict()
+    direct_port = None
+    metrics = Metrics()
+    replication = None
+    replica = None
 
-    def __init__(self):
+    QUEUE_COMMANDS = ('ADD', 'GET', 'ACK', 'IN', 'MADD', 'MGET', 'MACK', 'DLQ', 'REQUEUE', 'CONFIG')
+    REPLICA_COMMANDS = ('IN', 'STATS', 'PROMOTE', 'SHARD')
+
+    def __init__(self, internal=False):
         super().__init__()
-        self._buffer = b''
+        self._parser = CommandParser(ServerCore.max_payload)
+        self._stream = False
+        self._internal = internal
+        self._responses = deque()
         self.transport = None
 
     @classmethod
-    def restore_from_dump(cls):
+    def restore_from_dump(cls, fsync=('ms', 100), timeout=None):
         file_path = os.path.join(cls.path, cls.save_file_name)
         if os.path.isfile(file_path) and os.path.getsize(file_path):
-            with open(file_path, 'rb') as file:
-                cls.queue_storage = pickle.load(file)
+            cls.queue_storage = SnapshotFormat.load(file_path)
+        cls.queue_storage.set_spill(SpillStore(cls.path, cls.spill_threshold or None))
+        cls.queue_storage.set_max_attempts(cls.max_attempts)
+        cls.queue_storage.set_idle(cls.idle)
+        if timeout is not None:
+            # Очереди, создаваемые при чтении журнала, получают таймаут из параметров запуска
+            cls.queue_storage.set_timeout(timeout)
+
+        generation = cls.queue_storage.generation
+        Journal.remove_before(cls.path, generation)
+        for generation in Journal.generations(cls.path):
+            for kind, fields in Journal.read(cls.path, generation):
+                cls.queue_storage.replay(kind, fields)
+            generation += 1
+        cls.queue_storage.finish_replay()
+        cls.queue_storage.track_empty()
+
+        cls.journal = Journal(cls.path, generation, fsync)
+        cls.queue_storage.set_journal(cls.journal)
+        cls.snapshot = Snapshot(cls.path, cls.save_file_name)
+
+    @classmethod
+    def check_journal_size(cls):
+        if cls.journal.size > cls.journal_limit and not cls.snapshot.running:
+            cls.snapshot.save(cls.queue_storage, cls.journal)
 
     @staticmethod
-    def run_server(ip, port, path, timeout):
-        ServerCore.restore_from_dump()
-        ServerCore.queue_storage.set_timeout(timeout)
+    def run_server(ip, port, path, timeout, max_payload, fsync, workers=1, metrics_port=None,
+                   spill_threshold=64 * 2 ** 10, max_attempts=0, idle=600,
+                   replication_port=None, replica_of=None, event_loop='auto', direct_port=None):
+        ServerCore.spill_threshold = spill_threshold
+        ServerCore.max_attempts = max_attempts
+        ServerCore.idle = idle
+        if workers > 1:
+            if replication_port is not None or replica_of is not None:
+                raise SystemExit('Replication is not supported with several workers')
+            # Без своих портов воркеров почти каждая команда идет через пересылку между шардами
+            if direct_port is None:
+                direct_port = port + 1
+            ServerCore.run_sharded(ip, port, path, timeout, max_payload, fsync, workers, metrics_port,
+                                   event_loop, direct_port or None)
+            return
+
         ServerCore.path = path
-        loop = asyncio.get_event_loop()
+        ServerCore.max_payload = max_payload
+        ServerCore.restore_from_dump(fsync, timeout)
+        loop = ServerCore.new_event_loop(event_loop)
         coro = loop.create_server(
             ServerCore,
             ip, port
         )
-        server = loop.run_until_complete(coro)
+        servers = [loop.run_until_complete(coro)]
+        if metrics_port is not None:
+            servers.append(loop.run_until_complete(asyncio.start_server(
+                ServerCore.serve_metrics, ip, metrics_port)))
+        if replication_port is not None:
+            ServerCore.replication = ReplicationSource(ServerCore.journal)
+            servers.append(loop.run_until_complete(asyncio.start_server(
+                ServerCore.replication.serve, ip, replication_port)))
+        if replica_of is not None:
+            ServerCore.replica = Replica(replica_of[0], replica_of[1], fsync, timeout)
+            ServerCore.replica.start()
+        ServerCore.serve(loop, servers)
+
+    @staticmethod
+    def new_event_loop(kind):
+        # uvloop отдает writelines одним writev, не склеивая части ответа
+        if kind == 'uvloop' or kind == 'auto' and uvloop is not None:
+            if uvloop is None:
+                raise SystemExit('uvloop is not installed')
+            loop = uvloop.new_event_loop()
+        else:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+    @staticmethod
+    def reclaim_idle():
+        # Реплика удаляет очереди только по записям журнала основного сервера
+        try:
+            if ServerCore.replica is None:
+                ServerCore.queue_storage.reclaim_idle()
+        finally:
+            asyncio.get_event_loop().call_later(ServerCore.reclaim_interval, ServerCore.reclaim_idle)
+
+    @staticmethod
+    def serve(loop, servers):
+        loop.call_soon(ServerCore.reclaim_idle)
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
 
-        server.close()
-        loop.run_until_complete(server.wait_closed())
+        for server in servers:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        ServerCore.journal.close()
         loop.close()
-        
+
+    @staticmethod
+    def shard_path(path, shard):
+        return os.path.join(path, '.task_shard-{}'.format(shard))
+
+    @staticmethod
+    def run_sharded(ip, port, path, timeout, max_payload, fsync, workers, metrics_port=None,
+                    event_loop='auto', direct_port=None):
+        # Очереди закреплены за шардами хешем имени: другое число воркеров их потеряет
+        shards_file = os.path.join(path, '.task_shards')
+        if os.path.exists(shards_file):
+            with open(shards_file) as file:
+                if int(file.read()) != workers:
+                    raise SystemExit('{} was written for another number of workers'.format(shards_file))
+        else:
+            with open(shards_file, 'w') as file:
+                file.write(str(workers))
+
+        pids = []
+        for shard in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    ServerCore.run_worker(ip, port, path, timeout, max_payload, fsync, workers, shard,
+                                          metrics_port, event_loop, direct_port)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        def stop(signum, frame):
+            for pid in pids:
+                os.kill(pid, signal.SIGTERM)
+        signal.signal(signal.SIGTERM, stop)
+
+        for pid in pids:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except KeyboardInterrupt:
+                    # Ctrl+C получают и воркеры, ждем их завершения
+                    continue
+
+    @staticmethod
+    def run_worker(ip, port, path, timeout, max_payload, fsync, workers, shard, metrics_port=None,
+                   event_loop='auto', direct_port=None):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        ServerCore.path = ServerCore.shard_path(path, shard)
+        os.makedirs(ServerCore.path, exist_ok=True)
+        ServerCore.max_payload = max_payload
+        ServerCore.shard = shard
+        ServerCore.ring = HashRing(workers)
+        ServerCore.direct_port = direct_port
+        for other in range(workers):
+            if other != shard:
+                ServerCore.links[other] = ShardLink(os.path.join(
+                    ServerCore.shard_path(path, other), ServerCore.socket_name))
+        ServerCore.restore_from_dump(fsync, timeout)
+
+        loop = ServerCore.new_event_loop(event_loop)
+        socket_path = os.path.join(ServerCore.path, ServerCore.socket_name)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        servers = [
+            loop.run_until_complete(loop.create_server(ServerCore, ip, port, reuse_port=True)),
+            loop.run_until_complete(loop.create_unix_server(
+                lambda: ServerCore(internal=True), socket_path)),
+        ]
+        if metrics_port is not None:
+            servers.append(loop.run_until_complete(asyncio.start_server(
+                ServerCore.serve_metrics, ip, metrics_port, reuse_port=True)))
+        if direct_port is not None:
+            # Свой порт воркера: клиент, узнавший владельца очереди командой SHARD, обходится без пересылки
+            servers.append(loop.run_until_complete(loop.create_server(ServerCore, ip, direct_port + shard)))
+        ServerCore.serve(loop, servers)
+
+    @staticmethod
+    async def serve_metrics(reader, writer):
+        # Минимальный HTTP для Prometheus: метрики по GET /metrics
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        parts = request.split(b' ', 2)
+        if len(parts) == 3 and parts[0] == b'GET' and parts[1] in (b'/metrics', b'/'):
+            body = Metrics.prometheus(await ServerCore.collect_stats())
+            status = b'200 OK'
+        else:
+            body = b'not found\n'
+            status = b'404 Not Found'
+        writer.write(b'HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n\r\n%s' % (status, len(body), body))
+        await writer.drain()
+        writer.close()
+
+    @staticmethod
+    async def collect_stats():
+        stats = ServerCore.local_stats()
+        if ServerCore.ring is None:
+            return stats
+
+        results = [stats]
+        for shard in sorted(ServerCore.links):
+            resp = await ServerCore.links[shard].request(b'STATS\n')
+            if resp != b'ERROR':
+                results.append(json.loads(resp.decode()))
+        return Metrics.merge(results)
+
     def connection_made(self, transport):
         self.transport = transport
 
-    def process_add(self, data):
-        if len(data) != 3:
-            raise ParserException
+    def connection_lost(self, exc):
+        # Отложенные ответы больше некому отдать: ждущий GET не должен забрать задание
+        for resp in self._responses:
+            if isinstance(resp, asyncio.Future):
+                resp.cancel()
+        self._responses.clear()
 
-        try:
-            length = int(data[1])
-        except ValueError:
+    def process_add(self, data, payload):
+        if len(data) < 2 or payload is None:
             raise ParserException
 
-        if length != len(data[2]):
-            if len(data[2].encode()) < length:
-                raise LengthException
-            else:
+        priority, delay = self.parse_options(data[1:-1])
+        id_ = ServerCore.queue_storage.add_task(data[0], payload, priority, delay)
+        return Task.format_id(id_)
+
+    @staticmethod
+    def parse_options(options):
+        # Необязательные параметры ADD/MADD: priority=<int> и delay=<seconds>
+        values = {'priority': 0, 'delay': 0}
+        for option in options:
+            key, _, value = option.partition('=')
+            if key not in values:
+                raise ParserException
+            try:
+                values[key] = int(value) if key == 'priority' else float(value)
+            except ValueError:
                 raise ParserException
 
-        queue_name = data[0]
-        id_ = ServerCore.queue_storage.add_task(queue_name, data[2])
-        return id_
+        priority, delay = values['priority'], values['delay']
+        if not -2 ** 31 <= priority < 2 ** 31 or not 0 <= delay < float('inf'):
+            raise ParserException
+        return priority, delay
 
     def process_get(self, data):
-        if len(data) != 1:
+        if len(data) not in (1, 2):
             raise ParserException
 
+        wait = 0
+        if len(data) == 2:
+            try:
+                wait = float(data[1])
+            except ValueError:
+                raise ParserException
+            if not wait >= 0:
+                raise ParserException
+
         task = ServerCore.queue_storage.get_task(data[0])
+        if task is None and wait:
+            waiter = ServerCore.queue_storage.wait_task(data[0], wait)
+            return asyncio.ensure_future(self.wait_get(waiter))
+        return self.format_task(task)
+
+    @staticmethod
+    def format_task(task):
         if task is None:
-            return 'NONE'
+            return b'NONE'
+        if task[1] >= ServerCore.inline_payload or isinstance(task[2], memoryview):
+            # Большие данные и данные из сегмента уходят в сокет без копирования в новую строку
+            return [b'%s %d ' % (Task.format_id(task[0]), task[1]), task[2]]
+        return b'%s %d %s' % (Task.format_id(task[0]), task[1], task[2])
 
-        return '{0} {1} {2}'.format(*task)
+    @staticmethod
+    async def wait_get(waiter):
+        return ServerCore.format_task(await waiter)
 
     def process_ack(self, data):
         if len(data) != 2:
             raise ParserException
 
-        ack_state = ServerCore.queue_storage.ack_task(data[0], data[1])
-        return 'YES' if ack_state else 'NO'
+        ack_state = ServerCore.queue_storage.ack_task(data[0], Task.parse_id(data[1]))
+        return b'YES' if ack_state else b'NO'
 
-    def process_in(self, data):
+    def process_madd(self, data, payload):
+        if len(data) < 2 or payload is None:
+            raise ParserException
+
+        priority, delay = self.parse_options(data[1:-1])
+        ids = ServerCore.queue_storage.add_tasks(data[0], self.split_batch(payload), priority, delay)
+        return b' '.join(Task.format_id(id_) for id_ in ids)
+
+    def process_mget(self, data):
         if len(data) != 2:
             raise ParserException
 
-        in_state = ServerCore.queue_storage.in_task(data[0], data[1])
-        return 'YES' if in_state else 'NO'
+        try:
+            count = int(data[1])
+        except ValueError:
+            raise ParserException
+        if count < 1:
+            raise ParserException
+
+        tasks = ServerCore.queue_storage.get_tasks(data[0], count)
+        if not tasks:
+            return b'NONE'
 
-    def process_save(self):
-        with open(os.path.join(ServerCore.path, ServerCore.save_file_name), 'wb') as file:
-            pickle.dump(ServerCore.queue_storage, file)
-        return 'OK'
+        parts = [b'%d' % len(tasks)]
+        for id_, length, task_data in tasks:
+            parts.append(b' %s %d ' % (Task.format_id(id_), length))
+            parts.append(task_data)
+        return parts
 
-    def data_received(self, data):
+    def process_mack(self, data):
+        if len(data) < 2:
+            raise ParserException
+
+        ids = [Task.parse_id(id_) for id_ in data[1:]]
+        ack_states = ServerCore.queue_storage.ack_tasks(data[0], ids)
+        return b' '.join(b'YES' if ack_state else b'NO' for ack_state in ack_states)
+
+    @staticmethod
+    def split_batch(payload):
+        # Тело MADD: задания вида `<length> <data>`, разделенные пробелом
+        view = memoryview(payload)
+        datas = []
+        pos = 0
+        while pos < len(view):
+            space = payload.find(b' ', pos)
+            if space < 0 or not payload[pos:space].isdigit():
+                raise ParserException
+            end = space + 1 + int(payload[pos:space])
+            if end > len(view) or (end < len(view) and view[end] != ord(' ')):
+                raise ParserException
+            datas.append(bytes(view[space + 1:end]))
+            pos = end + 1
+        if not datas:
+            raise ParserException
+        return datas
+
+    def process_dlq(self, data):
+        if len(data) not in (1, 2):
+            raise ParserException
+
+        count = 10
+        if len(data) == 2:
+            try:
+                count = int(data[1])
+            except ValueError:
+                raise ParserException
+            if count < 0:
+                raise ParserException
+
+        total, tasks = ServerCore.queue_storage.dead_tasks(data[0], count)
+        parts = [b'%d' % total]
+        for task in tasks:
+            parts.append(b' %s %d %d ' % (Task.format_id(task.id), task.attempts, len(task.data)))
+            parts.append(task.data)
+        return parts
+
+    def process_requeue(self, data):
         if not data:
-            return
-        self._buffer += data
-        try:
-            decoded_data = self._buffer.decode()
-        except UnicodeDecodeError:
-            return
+            raise ParserException
+
+        if len(data) == 1:
+            return b'%d' % len(ServerCore.queue_storage.requeue_tasks(data[0]))
+        ids = [Task.parse_id(id_) for id_ in data[1:]]
+        states = ServerCore.queue_storage.requeue_tasks(data[0], ids)
+        return b' '.join(b'YES' if state else b'NO' for state in states)
+
+    def process_config(self, data):
+        if not data:
+            raise ParserException
+
+        if len(data) == 1:
+            return b'timeout=%g maxlen=%d idle=%g' % ServerCore.queue_storage.config(data[0])
+
+        values = {'timeout': None, 'maxlen': None, 'idle': None}
+        for option in data[1:]:
+            key, _, value = option.partition('=')
+            if key not in values:
+                raise ParserException
+            try:
+                values[key] = int(value) if key == 'maxlen' else float(value)
+            except ValueError:
+                raise ParserException
+            if not 0 <= values[key] < float('inf') or key == 'timeout' and not values[key]:
+                raise ParserException
+
+        ServerCore.queue_storage.configure(data[0], **values)
+        return b'OK'
+
+    def process_in(self, data):
+        if len(data) != 2:
+            raise ParserException
+
+        in_state = ServerCore.queue_storage.in_task(data[0], Task.parse_id(data[1]))
+        return b'YES' if in_state else b'NO'
+
+    def process_save(self, data):
+        if data == ['STATUS']:
+            return ServerCore.snapshot.status()
+        if data:
+            raise ParserException
+
+        saving = ServerCore.snapshot.save(ServerCore.queue_storage, ServerCore.journal)
+        return asyncio.ensure_future(self.wait_save(saving))
+
+    @staticmethod
+    async def wait_save(saving):
+        return b'OK' if await saving else b'ERROR'
+
+    def process_stats(self, data):
+        if data:
+            raise ParserException
+
+        if ServerCore.ring is None or self._internal:
+            return json.dumps(ServerCore.local_stats()).encode()
+        return asyncio.ensure_future(self.wait_stats())
+
+    @staticmethod
+    def local_stats():
+        replica = ServerCore.replica
+        stats = ServerCore.metrics.stats(ServerCore.queue_storage, readonly=replica is not None)
+        if replica is not None:
+            stats['replication'] = replica.stats()
+        elif ServerCore.replication is not None:
+            stats['replication'] = {'role': 'primary', 'followers': ServerCore.replication.followers}
+        return stats
+
+    def process_shard(self, data):
+        if len(data) != 1:
+            raise ParserException
+
+        if ServerCore.ring is None or ServerCore.direct_port is None:
+            return b'NONE'
+        return b'%d' % (ServerCore.direct_port + ServerCore.ring.find(data[0]))
+
+    def process_promote(self, data):
+        if data or ServerCore.replica is None:
+            raise ParserException
+
+        ServerCore.replica.stop()
+        ServerCore.replica = None
+        ServerCore.queue_storage.finish_replay()
+        ServerCore.queue_storage.track_empty()
+        return b'OK'
+
+    @staticmethod
+    async def wait_stats():
+        return json.dumps(await ServerCore.collect_stats()).encode()
 
-        split_data = decoded_data.split()
-        resp = None
+    def execute(self, command):
+        started = perf_counter()
+        resp = self.perform(command)
+        if not self._internal:
+            # Пересланные с другого шарда команды уже учтены там
+            ServerCore.metrics.observe(None if command is None else command[0][0], started, resp)
+        return resp
+
+    def perform(self, command):
+        if command is None:
+            return b'ERROR'
+
+        split_data, payload = command
+        if ServerCore.ring is not None and not self._internal:
+            routed = self.route(split_data, payload)
+            if routed is not None:
+                return routed
+        return self.dispatch(split_data, payload)
+
+    def route(self, split_data, payload):
+        data = ' '.join(split_data).encode()
+        data += b'\n' if payload is None else b' ' + payload + b'\n'
+
+        if split_data[0] == 'SAVE':
+            requests = dict((shard, asyncio.ensure_future(link.request(data)))
+                            for shard, link in ServerCore.links.items())
+            requests[ServerCore.shard] = self.dispatch(split_data, payload)
+            return asyncio.ensure_future(self.broadcast(requests, split_data == ['SAVE']))
+
+        if split_data[0] not in ServerCore.QUEUE_COMMANDS or len(split_data) < 2:
+            return None
+        shard = ServerCore.ring.find(split_data[1])
+        if shard == ServerCore.shard:
+            return None
+
+        link = ServerCore.links[shard]
+        if split_data[0] == 'GET' and len(split_data) == 3:
+            return asyncio.ensure_future(link.request_once(data))
+        return asyncio.ensure_future(link.request(data))
+
+    @staticmethod
+    async def broadcast(requests, combine):
+        responses = []
+        for shard in sorted(requests):
+            resp = requests[shard]
+            responses.append(resp if isinstance(resp, bytes) else await resp)
+        if combine:
+            return b'ERROR' if b'ERROR' in responses else b'OK'
+        # Состояние снимков перечисляется по номерам шардов
+        return b';'.join(responses)
+
+    def dispatch(self, split_data, payload):
+        if ServerCore.replica is not None and not self.replica_allows(split_data):
+            return b'READONLY'
         try:
             if split_data[0] == 'ADD':
-                resp = self.process_add(split_data[1:])
+                return self.process_add(split_data[1:], payload)
             elif split_data[0] == 'GET':
-                resp = self.process_get(split_data[1:])
+                return self.process_get(split_data[1:])
             elif split_data[0] == 'ACK':
-                resp = self.process_ack(split_data[1:])
+                return self.process_ack(split_data[1:])
             elif split_data[0] == 'IN':
-                resp = self.process_in(split_data[1:])
+                return self.process_in(split_data[1:])
+            elif split_data[0] == 'MADD':
+                return self.process_madd(split_data[1:], payload)
+            elif split_data[0] == 'MGET':
+                return self.process_mget(split_data[1:])
+            elif split_data[0] == 'MACK':
+                return self.process_mack(split_data[1:])
+            elif split_data[0] == 'DLQ':
+                return self.process_dlq(split_data[1:])
+            elif split_data[0] == 'REQUEUE':
+                return self.process_requeue(split_data[1:])
+            elif split_data[0] == 'CONFIG':
+                return self.process_config(split_data[1:])
             elif split_data[0] == 'SAVE':
-                if not len(data):  # Чтобы не передавать в функцию пустой параметр
-                    raise ParserException
-                resp = self.process_save()
+                return self.process_save(split_data[1:])
+            elif split_data[0] == 'STATS':
+                return self.process_stats(split_data[1:])
+            elif split_data[0] == 'SHARD':
+                return self.process_shard(split_data[1:])
+            elif split_data[0] == 'PROMOTE':
+                return self.process_promote(split_data[1:])
+            return b'ERROR'
+        except ParserException:
+            return b'ERROR'
+        except QueueFullException:
+            return b'FULL'
+
+    @staticmethod
+    def replica_allows(split_data):
+        # Реплика только читает: изменения приходят от основного сервера
+        if split_data[0] == 'CONFIG':
+            return len(split_data) == 2
+        if split_data[0] == 'SAVE':
+            return split_data[1:] == ['STATUS']
+        return split_data[0] in ServerCore.REPLICA_COMMANDS
+
+    def respond(self, resp):
+        self._responses.append(resp)
+        if isinstance(resp, asyncio.Future):
+            resp.add_done_callback(lambda _: self.flush_responses())
+        self.flush_responses()
+
+    def flush_responses(self):
+        # Ответы отдаются строго в порядке команд, даже если часть из них отложена
+        while self._responses and not self.transport.is_closing():
+            resp = self._responses[0]
+            if isinstance(resp, asyncio.Future):
+                if not resp.done():
+                    return
+                resp = resp.result()
+            self._responses.popleft()
+            self.write_response(resp)
+
+    def write_response(self, resp):
+        # Ответ может быть списком частей, если в нем данные из сегментов на диске
+        if self._stream:
+            # В потоковом режиме ответ предваряется своей длиной
+            if isinstance(resp, list):
+                self.transport.writelines([b'%d\n' % sum(map(len, resp))] + resp)
+            else:
+                self.transport.write(b'%d\n' % len(resp) + resp)
+        else:
+            if isinstance(resp, list):
+                self.transport.writelines(resp)
             else:
-                resp = 'ERROR'
-        except LengthException:
+                self.transport.write(resp)
+            self.transport.close()
+
+    def process_one_shot(self, commands):
+        if not commands:
+            commands = self._parser.flush()
+            if not commands:
+                return
+
+        if commands[0] is not None and commands[0][0] == ['STREAM']:
+            self._stream = True
+            self.respond(b'OK')
+            self.process_stream(commands[1:])
             return
-        except ParserException:
-            resp = 'ERROR'
 
-        self._buffer = b''
-        self.transport.write(resp.encode())
-        self.transport.close()
+        if len(commands) > 1 or self._parser.pending():
+            self.respond(b'ERROR')
+        else:
+            self.respond(self.execute(commands[0]))
+
+    def process_stream(self, commands):
+        for command in commands:
+            self.respond(self.execute(command))
+        if self._parser.broken:
+            self.transport.close()
+
+    def data_received(self, data):
+        if not data or self.transport.is_closing():
+            return
+        if not self._stream and self._responses:
+            # Одна команда на соединение: ждем отложенный ответ
+            return
+
+        commands = self._parser.feed(data)
+        if self._stream:
+            self.process_stream(commands)
+        else:
+            self.process_one_shot(commands)
+        ServerCore.check_journal_size()
+
+
+def fsync_policy(value):
+    if value in ('always', 'never'):
+        return (value, 0)
+
+    match = re.fullmatch(r'(\d+)(ms|ops)', value)
+    if not match or not int(match.group(1)):
+        raise argparse.ArgumentTypeError(
+            "expected 'always', 'never', '<N>ms' or '<N>ops', got {!r}".format(value))
+    return (match.group(2), int(match.group(1)))
+
+
+def address(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected '<host>:<port>', got {!r}".format(value))
+    return host, int(port)
 
 
 def parse_args():
@@ -267,6 +2549,84 @@ def parse_args():
         type=int,
         default=300,
         help='Task maximum GET timeout in seconds')
+    parser.add_argument(
+        '-m',
+        action="store",
+        dest="max_payload",
+        type=int,
+        default=10 ** 6,
+        help='Task maximum data length in bytes')
+    parser.add_argument(
+        '-f',
+        action="store",
+        dest="fsync",
+        type=fsync_policy,
+        default=fsync_policy('100ms'),
+        help="Journal fsync policy: 'always', 'never', '<N>ms' or '<N>ops'")
+    parser.add_argument(
+        '-w',
+        action="store",
+        dest="workers",
+        type=int,
+        default=1,
+        help='Number of worker processes, each owning a shard of the queues')
+    parser.add_argument(
+        '-e',
+        action="store",
+        dest="metrics_port",
+        type=int,
+        default=None,
+        help='Port of the HTTP endpoint with metrics in Prometheus text format')
+    parser.add_argument(
+        '-s',
+        action="store",
+        dest="spill_threshold",
+        type=int,
+        default=64 * 2 ** 10,
+        help='Task data of this many bytes or more is kept in memory-mapped files, 0 disables it')
+    parser.add_argument(
+        '-a',
+        action="store",
+        dest="max_attempts",
+        type=int,
+        default=0,
+        help='Deliveries after which a timed out task moves to <queue>.dlq, 0 means no limit')
+    parser.add_argument(
+        '-r',
+        action="store",
+        dest="idle",
+        type=float,
+        default=600,
+        help='Seconds after which an empty queue is removed, 0 keeps empty queues')
+    parser.add_argument(
+        '-l',
+        action="store",
+        dest="replication_port",
+        type=int,
+        default=None,
+        help='Port on which replicas can follow this server')
+    parser.add_argument(
+        '-R',
+        action="store",
+        dest="replica_of",
+        type=address,
+        default=None,
+        help="Run as a read-only replica of the primary at '<host>:<port>' (its -l port)")
+    parser.add_argument(
+        '-u',
+        action="store",
+        dest="event_loop",
+        choices=['auto', 'asyncio', 'uvloop'],
+        default='auto',
+        help='Event loop implementation, auto uses uvloop when it is installed')
+    parser.add_argument(
+        '-d',
+        action="store",
+        dest="direct_port",
+        type=int,
+        default=None,
+        help='With -w N, worker i also listens on this port + i (default: the port after -p, 0 turns it off); '
+             'SHARD <queue> tells clients the port')
     return parser.parse_args()
 
 if __name__ == '__main__':
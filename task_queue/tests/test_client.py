@@ -0,0 +1,120 @@
+from unittest import TestCase
+
+import asyncio
+import glob
+import os
+import shutil
+import subprocess
+import time
+
+from client import AsyncClient, Client, QueueFullException, Task
+
+
+class ClientTest(TestCase):
+    def setUp(self):
+        self.remove_dumps()
+        self.server = subprocess.Popen(['python3', 'server.py', '-t', '1'])
+        # даем серверу время на запуск
+        time.sleep(0.5)
+        self.client = Client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.terminate()
+        self.server.wait()
+        self.remove_dumps()
+
+    @staticmethod
+    def remove_dumps():
+        for file_name in glob.glob('.task_*'):
+            if os.path.isdir(file_name):
+                shutil.rmtree(file_name)
+            else:
+                os.remove(file_name)
+
+    def test_base_scenario(self):
+        task_id = self.client.add('1', b'12 45\n')
+        self.assertTrue(self.client.contains('1', task_id))
+        self.assertEqual(Task(task_id, b'12 45\n'), self.client.get('1'))
+        self.assertIsNone(self.client.get('1'))
+        self.assertTrue(self.client.ack('1', task_id))
+        self.assertFalse(self.client.ack('1', task_id))
+        self.assertFalse(self.client.contains('1', task_id))
+
+    def test_priority(self):
+        low = self.client.add('1', b'low')
+        high = self.client.add('1', b'high', priority=5)
+        self.assertEqual([high, low], [task.id for task in self.client.get_many('1', 2)])
+
+    def test_batch(self):
+        task_ids = self.client.add_many('1', [b'a', b'b c', b''])
+        self.assertEqual([Task(task_ids[0], b'a'), Task(task_ids[1], b'b c')], self.client.get_many('1', 2))
+        self.assertEqual([Task(task_ids[2], b'')], self.client.get_many('1', 2))
+        self.assertEqual([], self.client.get_many('1', 2))
+        self.assertEqual([True, False, True], self.client.ack_many('1', [task_ids[0], 'x', task_ids[2]]))
+
+    def test_wait(self):
+        self.assertIsNone(self.client.get('1', wait=0.1))
+        task_id = self.client.add('1', b'x', delay=0.2)
+        self.assertEqual(Task(task_id, b'x'), self.client.get('1', wait=1))
+
+    def test_full(self):
+        self.assertEqual(b'OK', self.client.request(b'CONFIG 1 maxlen=1'))
+        self.client.add('1', b'x')
+        with self.assertRaises(QueueFullException):
+            self.client.add('1', b'y')
+
+    def test_pipelining(self):
+        async def scenario():
+            async with AsyncClient(pool_size=2) as client:
+                task_ids = await asyncio.gather(*[client.add('1', b'%d' % index) for index in range(100)])
+                tasks = await asyncio.gather(*[client.get('1') for _ in range(100)])
+                return task_ids, tasks
+
+        task_ids, tasks = asyncio.run(scenario())
+        self.assertEqual(100, len(set(task_ids)))
+        self.assertEqual(set(task_ids), set(task.id for task in tasks))
+
+    def test_one_shot(self):
+        async def scenario():
+            async with AsyncClient(stream=False) as client:
+                task_id = await client.add('1', b'12 45')
+                return task_id, await client.get('1'), await client.ack('1', task_id)
+
+        task_id, task, acked = asyncio.run(scenario())
+        self.assertEqual(Task(task_id, b'12 45'), task)
+        self.assertTrue(acked)
+
+    def test_consume(self):
+        task_ids = self.client.add_many('1', [b'%d' % index for index in range(10)])
+        handled = []
+
+        async def handler(task):
+            await asyncio.sleep(0.01)
+            if task.data == b'3':
+                raise ValueError(task.data)
+            handled.append(task.id)
+
+        self.client.consume('1', handler, concurrency=4, wait=0.1, limit=10)
+        self.assertEqual(set(task_ids) - {task_ids[3]}, set(handled))
+        self.assertTrue(self.client.contains('1', task_ids[3]))
+        self.assertFalse(self.client.contains('1', task_ids[0]))
+
+    def test_routing(self):
+        self.server.terminate()
+        self.server.wait()
+        self.server = subprocess.Popen(['python3', 'server.py', '-t', '1', '-w', '2'])
+        time.sleep(0.5)
+
+        with Client() as client:
+            task_ids = [client.add(str(index), b'%d' % index) for index in range(10)]
+            for index, task_id in enumerate(task_ids):
+                self.assertEqual(Task(task_id, b'%d' % index), client.get(str(index)))
+                self.assertTrue(client.ack(str(index), task_id))
+            # Каждая очередь обслуживалась напрямую своим воркером
+            self.assertEqual({5555, 5556, 5557}, set(client._client._pools))
+
+        with Client(routing=False) as client:
+            task_id = client.add('0', b'x')
+            self.assertEqual(Task(task_id, b'x'), client.get('0'))
+            self.assertEqual({5555}, set(client._client._pools))
@@ -1,29 +1,68 @@
-from unittest import TestCase
+from unittest import TestCase, skip
 
+import glob
+import json
+import os
+import shutil
 import time
 import socket
 import subprocess
+import tempfile
+import urllib.request
 
 
 class ServerBaseTest(TestCase):
+    server_args = []
+
     def setUp(self):
-        subprocess.run(["rm", "-f", ".task_save"])
-        self.server = subprocess.Popen(['python3', 'server.py', '-t', '1'])
+        self.remove_dumps()
+        self.start_server('-t', '1')
+
+    def start_server(self, *args):
+        self.server = subprocess.Popen(['python3', 'server.py'] + list(args) + self.server_args)
         # даем серверу время на запуск
         time.sleep(0.5)
 
     def tearDown(self):
         self.server.terminate()
         self.server.wait()
+        self.remove_dumps()
+
+    @staticmethod
+    def remove_dumps():
+        for file_name in glob.glob('.task_*'):
+            if os.path.isdir(file_name):
+                shutil.rmtree(file_name)
+            else:
+                os.remove(file_name)
+
+    @staticmethod
+    def remove_journals():
+        for file_name in glob.glob('.task_journal.*') + glob.glob('.task_shard-*/.task_journal.*'):
+            os.remove(file_name)
 
-    def send(self, command):
+    def send(self, command, port=5555):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('127.0.0.1', 5555))
+        s.connect(('127.0.0.1', port))
         s.send(command)
         data = s.recv(1000000)
         s.close()
         return data
 
+    def send_stream(self, commands):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(b'STREAM\n' + b''.join(command + b'\n' for command in commands))
+        reader = s.makefile('rb')
+        responses = []
+        for _ in range(len(commands) + 1):
+            length = int(reader.readline())
+            responses.append(reader.read(length))
+        reader.close()
+        s.close()
+        self.assertEqual(b'OK', responses[0])
+        return responses[1:]
+
     def test_base_scenario(self):
         task_id = self.send(b'ADD 1 5 12345')
         self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
@@ -56,8 +95,244 @@ class ServerBaseTest(TestCase):
         self.assertEqual(b'YES', self.send(b'IN 1 ' + task_id))
         self.assertEqual(task_id + b' ' + data, self.send(b'GET 1'))
 
+    def test_segmented_input(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        for part in (b'ADD 1 ', b'11 hello', b' ', b'world'):
+            s.send(part)
+            time.sleep(0.05)
+        task_id = s.recv(1000)
+        s.close()
+        self.assertEqual(task_id + b' 11 hello world', self.send(b'GET 1'))
+
+    def test_too_long_input(self):
+        self.assertEqual(b'ERROR', self.send(b'ADD 1 2000000 12345'))
+
+    def test_batch(self):
+        first_task_id, second_task_id = self.send(b'MADD 1 13 5 12345 3 a b').split()
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + second_task_id))
+        self.assertEqual(b'2 ' + first_task_id + b' 5 12345 ' + second_task_id + b' 3 a b',
+                         self.send(b'MGET 1 10'))
+        self.assertEqual(b'NONE', self.send(b'MGET 1 10'))
+        self.assertEqual(b'YES NO YES',
+                         self.send(b'MACK 1 ' + first_task_id + b' x ' + second_task_id))
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + first_task_id))
+
+    def test_batch__bad(self):
+        self.assertEqual(b'ERROR', self.send(b'MADD 1 7 9 12345'))
+        self.assertEqual(b'ERROR', self.send(b'MGET 1 0'))
+        self.assertEqual(b'ERROR', self.send(b'MACK 1'))
+
+    def test_wait(self):
+        waiting = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        waiting.connect(('127.0.0.1', 5555))
+        waiting.send(b'GET 1 5')
+        time.sleep(0.2)
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', waiting.recv(1000))
+        waiting.close()
+
+    def test_wait_timeout(self):
+        started = time.time()
+        self.assertEqual(b'NONE', self.send(b'GET 1 0.3'))
+        self.assertGreaterEqual(time.time() - started, 0.3)
+
+    def test_wait_redelivery(self):
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1 3'))
+
+    def test_priority(self):
+        low_task_id = self.send(b'ADD 1 priority=-1 3 low')
+        first_task_id = self.send(b'ADD 1 5 first')
+        high_task_id = self.send(b'ADD 1 priority=5 4 high')
+        second_task_id = self.send(b'ADD 1 6 second')
+        self.assertEqual(high_task_id + b' 4 high', self.send(b'GET 1'))
+        self.assertEqual(first_task_id + b' 5 first', self.send(b'GET 1'))
+        self.assertEqual(second_task_id + b' 6 second', self.send(b'GET 1'))
+        self.assertEqual(low_task_id + b' 3 low', self.send(b'GET 1'))
+
+        time.sleep(1.1)
+        self.assertEqual(high_task_id + b' 4 high', self.send(b'GET 1'))
+
+    def test_delay(self):
+        task_id = self.send(b'ADD 1 delay=0.5 5 12345')
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1 2'))
+        self.assertEqual(b'ERROR', self.send(b'ADD 1 delay=-1 5 12345'))
+        self.assertEqual(b'ERROR', self.send(b'ADD 1 weight=1 5 12345'))
+
+    def test_spill(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-s', '100')
+        spill_files = lambda: glob.glob('.task_spill.*') + glob.glob('.task_shard-*/.task_spill.*')
+
+        data = bytes(range(256)) * 4
+        task_id = self.send(b'ADD 1 1024 ' + data)
+        small_task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(1, len(spill_files()))
+        self.assertEqual(task_id + b' 1024 ' + data, self.send(b'GET 1'))
+        self.assertEqual([small_task_id + b' 5 12345'], self.send_stream([b'GET 1']))
+        self.assertEqual([task_id + b' 1024 ' + data], self.send_stream([b'GET 1 2']))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+        self.assertEqual([], spill_files())
+
+        second_task_id = self.send(b'ADD 2 1024 ' + data)
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-s', '100')
+        self.assertEqual(1, len(spill_files()))
+        self.assertEqual(b'1 ' + second_task_id + b' 1024 ' + data, self.send(b'MGET 2 5'))
+
+    def test_dead_letter(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-a', '2')
+
+        task_id = self.send(b'ADD 1 5 12345')
+        other_task_id = self.send(b'ADD 1 5 67890')
+        for _ in range(2):
+            self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+            time.sleep(1.1)
+        self.assertEqual(b'1 ' + task_id + b' 2 5 12345', self.send(b'DLQ 1'))
+        self.assertEqual(other_task_id + b' 5 67890', self.send(b'GET 1'))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + task_id))
+        self.assertEqual(b'YES', self.send(b'IN 1.dlq ' + task_id))
+
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-a', '2')
+        self.assertEqual(b'1 ' + task_id + b' 2 5 12345', self.send(b'DLQ 1'))
+        self.assertEqual(b'YES NO', self.send(b'REQUEUE 1 ' + task_id + b' ' + other_task_id))
+        self.assertEqual(b'0', self.send(b'DLQ 1'))
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+    def test_config(self):
+        self.assertEqual(b'timeout=1 maxlen=0 idle=600', self.send(b'CONFIG 1'))
+        self.assertEqual(b'OK', self.send(b'CONFIG 1 timeout=2.5 maxlen=1'))
+        self.assertEqual(b'ERROR', self.send(b'CONFIG 1 timeout=0'))
+        self.assertEqual(b'ERROR', self.send(b'CONFIG 1 size=1'))
+
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(b'FULL', self.send(b'ADD 1 5 12345'))
+        self.assertEqual(b'FULL', self.send(b'MADD 1 7 1 a 1 b'))
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        time.sleep(1.1)
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1')
+        self.assertEqual(b'timeout=2.5 maxlen=1 idle=600', self.send(b'CONFIG 1'))
+
+    def test_idle_queue(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-r', '0.5')
+
+        self.assertEqual(b'OK', self.send(b'CONFIG 2 idle=0 maxlen=5'))
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+        self.assertEqual({'1', '2'}, set(json.loads(self.send(b'STATS').decode())['queues']))
+        time.sleep(1.6)
+        self.assertEqual({'2'}, set(json.loads(self.send(b'STATS').decode())['queues']))
+        self.assertEqual(b'timeout=1 maxlen=5 idle=0', self.send(b'CONFIG 2'))
+
+    def test_idle_queue_config(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-r', '0.5')
+
+        self.assertEqual(b'OK', self.send(b'CONFIG 1 timeout=2 maxlen=1'))
+        time.sleep(1.6)
+        self.assertEqual(set(), set(json.loads(self.send(b'STATS').decode())['queues']))
+        self.assertEqual(b'timeout=2 maxlen=1 idle=0.5', self.send(b'CONFIG 1'))
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(b'FULL', self.send(b'ADD 1 5 12345'))
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+        time.sleep(1.6)
+
+        # Настройки удаленной очереди восстанавливаются из журнала и из снимка
+        for command in (b'STATS', b'SAVE'):
+            self.send(command)
+            self.server.terminate()
+            self.server.wait()
+            self.start_server('-t', '1', '-r', '0.5')
+            self.assertEqual(b'timeout=2 maxlen=1 idle=0.5', self.send(b'CONFIG 1'))
+
+    def test_replication(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-l', '5557')
+        first_task_id = self.send(b'ADD 1 5 12345')
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replica = subprocess.Popen(['python3', os.path.abspath('server.py'), '-p', '5556', '-c', directory.name,
+                                    '-R', '127.0.0.1:5557', '-t', '1'])
+        self.addCleanup(replica.wait)
+        self.addCleanup(replica.terminate)
+        time.sleep(0.5)
+
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + first_task_id, 5556))
+        second_task_id = self.send(b'ADD 1 5 67890')
+        for _ in range(50):
+            if self.send(b'IN 1 ' + second_task_id, 5556) == b'YES':
+                break
+            time.sleep(0.05)
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + second_task_id, 5556))
+        self.assertEqual(b'READONLY', self.send(b'ADD 1 5 12345', 5556))
+        self.assertEqual(b'READONLY', self.send(b'CONFIG 1 maxlen=1', 5556))
+        self.assertEqual(b'timeout=1 maxlen=0 idle=600', self.send(b'CONFIG 1', 5556))
+
+        self.server.terminate()
+        self.server.wait()
+        self.assertEqual(b'OK', self.send(b'PROMOTE', 5556))
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1', 5556))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + first_task_id, 5556))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(b'GET 1', 5556))
+        self.assertEqual(b'ERROR', self.send(b'PROMOTE', 5556))
+
+    def test_replicated_drop(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-t', '1', '-r', '0.5', '-l', '5557')
+        task_id = self.send(b'ADD 1 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + task_id))
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replica = subprocess.Popen(['python3', os.path.abspath('server.py'), '-p', '5556', '-c', directory.name,
+                                    '-R', '127.0.0.1:5557', '-t', '1', '-r', '0.5'])
+        self.addCleanup(replica.wait)
+        self.addCleanup(replica.terminate)
+        time.sleep(2)
+        self.assertEqual({}, json.loads(self.send(b'STATS', 5556).decode())['queues'])
+
+        # Удаление очереди, полученное от основного сервера, не ломает очистку после PROMOTE
+        self.server.terminate()
+        self.server.wait()
+        self.assertEqual(b'OK', self.send(b'PROMOTE', 5556))
+        task_id = self.send(b'ADD 2 5 12345', 5556)
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 2', 5556))
+        self.assertEqual(b'YES', self.send(b'ACK 2 ' + task_id, 5556))
+        time.sleep(2)
+        self.assertEqual({}, json.loads(self.send(b'STATS', 5556).decode())['queues'])
+
+    def test_shard(self):
+        self.assertEqual(b'NONE', self.send(b'SHARD 1'))
+        self.assertEqual(b'ERROR', self.send(b'SHARD'))
+
     def test_wrong_command(self):
         self.assertEqual(b'ERROR', self.send(b'ADDD 1 5 12345'))
+        self.assertEqual(b'ERROR', self.send(b'ADD 1 abc 12345'))
+        self.assertEqual(b'ERROR', self.send(b'MADD 1 priority=1 x 1 a'))
 
     def test_timeout(self):
         first_task_id = self.send(b'ADD 1 5 12345')
@@ -65,9 +340,78 @@ class ServerBaseTest(TestCase):
         time.sleep(1)
         self.assertEqual(b'NO', self.send(b'ACK 1 ' + first_task_id))
 
+    def test_timeout_order(self):
+        first_task_id = self.send(b'ADD 1 5 12345')
+        second_task_id = self.send(b'ADD 1 5 67890')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(b'GET 1'))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        time.sleep(1.1)
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + first_task_id))
+
+    def test_large_payload(self):
+        data = bytes(range(256)) * 8
+        task_id = self.send(b'ADD 1 2048 ' + data)
+        self.assertEqual(task_id + b' 2048 ' + data, self.send(b'GET 1'))
+        self.assertEqual([b'YES', b'NONE'], self.send_stream([b'ACK 1 ' + task_id, b'GET 1']))
+
+        task_id, task = self.send_stream([b'ADD 1 2048 ' + data, b'GET 1'])
+        self.assertEqual(task_id + b' 2048 ' + data, task)
+
+    def test_stream(self):
+        task_id, in_state, task = self.send_stream([b'ADD 1 5 12345', b'IN 1 x', b'GET 1'])
+        self.assertEqual(b'NO', in_state)
+        self.assertEqual(task_id + b' 5 12345', task)
+
+        responses = self.send_stream([b'ACK 1 ' + task_id, b'ACK 1 ' + task_id, b'ADDD'])
+        self.assertEqual([b'YES', b'NO', b'ERROR'], responses)
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+
     def test_save(self):
         self.assertEqual(b'OK', self.send(b'SAVE'))
 
+    def test_save_status(self):
+        self.assertEqual(b'IDLE', self.send(b'SAVE STATUS'))
+        self.send(b'ADD 1 5 12345')
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        status, size = self.send(b'SAVE STATUS').split()
+        self.assertEqual(b'DONE', status)
+        self.assertEqual(os.path.getsize('.task_save'), int(size))
+
+    def test_stats(self):
+        task_id = self.send(b'ADD 1 5 12345')
+        self.send(b'ADD 1 5 12345')
+        self.send(b'ADD 2 5 12345')
+        self.assertEqual(task_id + b' 5 12345', self.send(b'GET 1'))
+        self.send(b'WRONG')
+
+        stats = json.loads(self.send(b'STATS').decode())
+        self.assertEqual({'tasks': 2, 'ready': 1, 'delayed': 0, 'in_flight': 1, 'added': 2,
+                          'delivered': 1, 'acked': 0, 'redelivered': 0, 'dead_lettered': 0},
+                         stats['queues']['1'])
+        self.assertEqual(1, stats['queues']['2']['ready'])
+        self.assertEqual(3, stats['commands']['ADD']['count'])
+        self.assertEqual(3, sum(stats['commands']['ADD']['buckets']))
+        self.assertEqual(1, stats['commands']['OTHER']['errors'])
+
+        time.sleep(1.1)
+        stats = json.loads(self.send(b'STATS').decode())
+        self.assertEqual(1, stats['queues']['1']['redelivered'])
+        self.assertEqual(2, stats['queues']['1']['ready'])
+
+    def test_stats_http(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-e', '5559')
+        self.send(b'ADD 1 5 12345')
+
+        with urllib.request.urlopen('http://127.0.0.1:5559/metrics') as response:
+            body = response.read().decode()
+        self.assertIn('task_queue_command_duration_seconds_count{command="ADD"} 1\n', body)
+        self.assertIn('task_queue_ready{queue="1"} 1\n', body)
+
     def test_restore(self):
         subprocess.run(["rm", "-f", ".task_save"])
         first_task_id = self.send(b'ADD 1 5 12345')
@@ -78,11 +422,123 @@ class ServerBaseTest(TestCase):
         self.server.terminate()
         self.server.wait()
 
-        self.server = subprocess.Popen(["python3", "server.py"])
-        time.sleep(0.5)
+        self.start_server()
         self.assertEqual(b'YES', self.send(b'IN 1 ' + first_task_id))
         self.assertEqual(b'YES', self.send(b'IN 1 ' + second_task_id))
 
+    def test_restore_snapshot(self):
+        first_task_id = self.send(b'ADD 1 5 12345')
+        second_task_id = self.send(b'ADD 2 11 hello world')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        self.server.terminate()
+        self.server.wait()
+        self.remove_journals()
+
+        self.start_server('-t', '1')
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + first_task_id))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        self.assertEqual(second_task_id + b' 11 hello world', self.send(b'GET 2'))
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        time.sleep(1)
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+
+    def test_restore_priority(self):
+        low_task_id = self.send(b'ADD 1 5 12345')
+        high_task_id = self.send(b'ADD 1 priority=2 5 12345')
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        delayed_task_id = self.send(b'ADD 1 priority=3 delay=2 5 12345')
+        self.server.terminate()
+        self.server.wait()
+
+        self.start_server()
+        self.assertEqual(high_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(low_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        self.send(b'MACK 1 ' + high_task_id + b' ' + low_task_id)
+        self.assertEqual(delayed_task_id + b' 5 12345', self.send(b'GET 1 3'))
+
+    def test_restore_journal(self):
+        first_task_id = self.send(b'ADD 1 5 12345')
+        second_task_id = self.send(b'ADD 1 5 67890')
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        third_task_id = self.send(b'ADD 1 5 abcde')
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+        self.assertEqual(second_task_id + b' 5 67890', self.send(b'GET 1'))
+        self.assertEqual(b'YES', self.send(b'ACK 1 ' + second_task_id))
+        self.server.terminate()
+        self.server.wait()
+
+        self.start_server('-t', '1')
+        self.assertEqual(b'YES', self.send(b'IN 1 ' + first_task_id))
+        self.assertEqual(b'NO', self.send(b'IN 1 ' + second_task_id))
+        self.assertEqual(third_task_id + b' 5 abcde', self.send(b'GET 1'))
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        time.sleep(1)
+        self.assertEqual(first_task_id + b' 5 12345', self.send(b'GET 1'))
+
+
+class ShardedServerTest(ServerBaseTest):
+    server_args = ['-w', '3']
+
+    def test_save_status(self):
+        self.assertEqual(b'IDLE;IDLE;IDLE', self.send(b'SAVE STATUS'))
+        self.assertEqual(b'OK', self.send(b'SAVE'))
+        statuses = self.send(b'SAVE STATUS').split(b';')
+        self.assertEqual([b'DONE'] * 3, [status.split()[0] for status in statuses])
+
+    def test_many_queues(self):
+        queues = [str(index).encode() for index in range(20)]
+        task_ids = self.send_stream([b'ADD ' + queue + b' 1 x' for queue in queues])
+        for queue, task_id in zip(queues, task_ids):
+            self.assertEqual(task_id + b' 1 x', self.send(b'GET ' + queue))
+            self.assertEqual(b'YES', self.send(b'ACK ' + queue + b' ' + task_id))
+
+    def test_workers_changed(self):
+        self.server.terminate()
+        self.server.wait()
+        self.server = subprocess.Popen(['python3', 'server.py', '-w', '2'],
+                                       stderr=subprocess.DEVNULL)
+        self.assertNotEqual(0, self.server.wait())
+
+    def test_replication(self):
+        self.server.terminate()
+        self.server.wait()
+        self.server = subprocess.Popen(['python3', 'server.py', '-l', '5557'] + self.server_args,
+                                       stderr=subprocess.DEVNULL)
+        self.assertNotEqual(0, self.server.wait())
+
+    def test_direct_ports(self):
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-d', '5560')
+
+        queues = [str(index).encode() for index in range(20)]
+        ports = [int(self.send(b'SHARD ' + queue)) for queue in queues]
+        self.assertEqual({5560, 5561, 5562}, set(ports))
+        self.assertEqual(b'%d' % ports[0], self.send(b'SHARD 0', ports[1]))
+        for queue, port in zip(queues, ports):
+            task_id = self.send(b'ADD ' + queue + b' 1 x', port)
+            self.assertEqual(task_id + b' 1 x', self.send(b'GET ' + queue))
+            # Команда для чужой очереди на порту воркера пересылается, как на общем порту
+            other = 5560 + (port - 5559) % 3
+            self.assertEqual(b'YES', self.send(b'ACK ' + queue + b' ' + task_id, other))
+
+    def test_shard(self):
+        # Свои порты воркеров по умолчанию идут сразу за общим
+        ports = [int(self.send(b'SHARD ' + str(index).encode())) for index in range(20)]
+        self.assertEqual({5556, 5557, 5558}, set(ports))
+        self.assertEqual(b'ERROR', self.send(b'SHARD'))
+
+        self.server.terminate()
+        self.server.wait()
+        self.start_server('-d', '0')
+        self.assertEqual(b'NONE', self.send(b'SHARD 0'))
+
+    @skip('replication is not supported with -w')
+    def test_replicated_drop(self):
+        pass
+
 
 if __name__ == '__main__':
     unittest.main()
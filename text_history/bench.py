@@ -0,0 +1,164 @@
+from time import perf_counter
+import argparse
+import os
+import pickle
+import tempfile
+
+from text_history import HISTORY_MAGIC, TextHistory, decode_actions, encode_actions, encode_checkpoint
+
+
+def measure(func, count):
+    timer = perf_counter()
+    for _ in range(count):
+        func()
+    return (perf_counter() - timer) / count
+
+
+def linear_find(actions, version):
+    # Поиск версии до индекса версий: перебор всей истории
+    for index, action in enumerate(actions):
+        if action.from_version == version:
+            return index
+        elif action.to_version == version:
+            return index + 1
+    raise ValueError()
+
+
+def build_history(size):
+    history = TextHistory()
+    for index in range(size):
+        history.insert('x', pos=index // 2)
+    return history
+
+
+def bench_sync(history, behind, samples):
+    version = history.version - behind
+    return measure(lambda: history.get_actions(version), samples)
+
+
+def bench_linear(history, behind, samples):
+    version = history.version - behind
+    actions = history._actions
+    return measure(lambda: actions[linear_find(actions, version):], samples)
+
+
+def bench_text_at(history, samples):
+    # Версии по возрастанию в конце истории: первое чтение переигрывает историю с начала,
+    # следующие - от контрольных точек, которые оставили предыдущие чтения
+    start = max(history.version - samples * 7, 0)
+    versions = iter(range(start, history.version + 1, 7))
+    first = measure(lambda: history.text_at(next(versions)), 1)
+    count = max(min(samples, (history.version - start) // 7), 1)
+    return first, measure(lambda: history.text_at(next(versions)), count)
+
+
+def bench_encoding(history):
+    actions = history._actions
+    result = {}
+    timer = perf_counter()
+    data = b''.join(encode_actions(actions))
+    result['encode'] = perf_counter() - timer
+    timer = perf_counter()
+    decode_actions(data)
+    result['decode'] = perf_counter() - timer
+    result['bytes'] = len(data) / len(actions)
+    result['pickle'] = len(pickle.dumps(actions)) / len(actions)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'history')
+        with open(path, 'wb') as file:
+            file.write(HISTORY_MAGIC + data)
+        timer = perf_counter()
+        TextHistory.open(path).close()
+        result['replay'] = perf_counter() - timer
+
+        # Файл с контрольной точкой после последнего действия: действия только разбираются
+        with open(path, 'ab') as file:
+            file.write(encode_checkpoint(len(actions), history.text))
+        timer = perf_counter()
+        TextHistory.open(path).close()
+        result['reload'] = perf_counter() - timer
+    return result
+
+
+def bench_edits(backend, size, edits):
+    history = TextHistory(backend)
+    history.insert('x' * size)
+    timer = perf_counter()
+    for index in range(edits):
+        history.insert('a', pos=size // 2 + index)
+    return (perf_counter() - timer) / edits
+
+
+def print_table(title, columns, rows):
+    print(title)
+    print(''.join('{:>12}'.format(column) for column in columns))
+    for row in rows:
+        print(''.join('{:>12}'.format(cell) for cell in row))
+    print()
+
+
+def run_sync(histories, samples, behinds=(1, 10, 100)):
+    rows = []
+    for size, history in histories.items():
+        rows.append([size] + ['{:.2f}us'.format(bench_sync(history, behind, samples) * 1e6)
+                              for behind in behinds])
+        rows.append(['linear'] + ['{:.2f}us'.format(bench_linear(history, behind, max(samples // 100, 1)) * 1e6)
+                                  for behind in behinds])
+    print_table('get_actions for a client behind the head',
+                ['actions'] + ['-{}'.format(behind) for behind in behinds], rows)
+
+
+def run_text_at(histories, samples):
+    rows = []
+    for size, history in histories.items():
+        first, next_reads = bench_text_at(history, samples)
+        rows.append([size, '{:.3f}s'.format(first), '{:.2f}us'.format(next_reads * 1e6)])
+    print_table('text_at a recent version, checkpoint every 1000 actions', ['actions', 'first', 'next'], rows)
+
+
+def run_encoding(histories):
+    rows = []
+    for size, history in histories.items():
+        result = bench_encoding(history)
+        rows.append([size, '{:.1f}'.format(result['bytes']), '{:.1f}'.format(result['pickle'])] +
+                    ['{:.3f}s'.format(result[key]) for key in ('encode', 'decode', 'replay', 'reload')])
+    print_table('Binary encoding of the whole history, bytes per action',
+                ['actions', 'bytes', 'pickle', 'encode', 'decode', 'replay', 'reload'], rows)
+
+
+def run_edits(sizes, edits=1000):
+    rows = [[size] + ['{:.2f}us'.format(bench_edits(backend, size, edits) * 1e6)
+                      for backend in ('string', 'rope')]
+            for size in sizes]
+    print_table('Keystroke insert in the middle of a document', ['chars', 'string', 'rope'], rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TextHistory benchmarks')
+    parser.add_argument(
+        '-s',
+        action="store",
+        dest="sizes",
+        type=int,
+        nargs='+',
+        default=[10000, 100000, 1000000],
+        help='History lengths and document sizes to measure')
+    parser.add_argument(
+        '-n',
+        action="store",
+        dest="samples",
+        type=int,
+        default=1000,
+        help='Operations per measurement')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    # Построение истории дороже самих замеров: каждая строится один раз на все таблицы
+    HISTORIES = dict((size, build_history(size)) for size in ARGS.sizes)
+    run_sync(HISTORIES, ARGS.samples)
+    run_text_at(HISTORIES, ARGS.samples)
+    run_encoding(HISTORIES)
+    run_edits(ARGS.sizes)
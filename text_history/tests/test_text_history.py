@@ -1,6 +1,11 @@
 from unittest import TestCase
 
-from text_history import TextHistory, InsertAction, ReplaceAction, DeleteAction
+import os
+import random
+import tempfile
+
+from text_history import TextHistory, InsertAction, ReplaceAction, DeleteAction, Rope, StringText
+from text_history import ActionDecoder, decode_actions, encode_actions, encode_checkpoint
 
 
 class TextHistoryTestCase(TestCase):
@@ -126,24 +131,17 @@ class TextHistoryTestCase(TestCase):
 
         actions = h.get_actions(1)
 
-        self.assertEqual(3, len(actions))
-        insert, replace, delete = actions
+        self.assertEqual(2, len(actions))
+        insert, delete = actions
         self.assertIsInstance(insert, InsertAction)
-        self.assertIsInstance(replace, ReplaceAction)
         self.assertIsInstance(delete, DeleteAction)
 
-        # insert
+        # insert, замененная внутри вставленного текста
         self.assertEqual(1, insert.from_version)
-        self.assertEqual(2, insert.to_version)
-        self.assertEqual('bc', insert.text)
+        self.assertEqual(3, insert.to_version)
+        self.assertEqual('Bc', insert.text)
         self.assertEqual(1, insert.pos)
 
-        # replace
-        self.assertEqual(2, replace.from_version)
-        self.assertEqual(3, replace.to_version)
-        self.assertEqual('B', replace.text)
-        self.assertEqual(1, replace.pos)
-
         # delete
         self.assertEqual(3, delete.from_version)
         self.assertEqual(4, delete.to_version)
@@ -172,30 +170,85 @@ class TextHistoryTestCase(TestCase):
         h.insert('a')
         self.assertEqual([], h.get_actions(0, 0))
 
+    def test_get_actions__versions(self):
+        h = TextHistory()
+        h.action(InsertAction(pos=0, text='abc', from_version=0, to_version=10))
+        h.insert('d')
+        h.action(DeleteAction(pos=0, length=1, from_version=11, to_version=20))
+
+        self.assertEqual([11, 20], [action.to_version for action in h.get_actions(10)])
+        self.assertEqual([20], [action.to_version for action in h.get_actions(11, 20)])
+        self.assertEqual([], h.get_actions(20))
+        with self.assertRaises(ValueError):
+            h.get_actions(5)
+        with self.assertRaises(ValueError):
+            h.get_actions(0, 15)
+
+    def test_text_at(self):
+        h = TextHistory(checkpoint_interval=3)
+        texts = {0: ''}
+        for index in range(20):
+            h.insert(str(index % 10), pos=index // 2)
+            if index % 4 == 3:
+                h.delete(pos=1, length=1)
+            texts[h.version] = h.text
+
+        for version, text in texts.items():
+            self.assertEqual(text, h.text_at(version))
+
+        with self.assertRaises(ValueError):
+            h.text_at(h.version + 1)
+
+    def test_text_at__evicted(self):
+        h = TextHistory(backend='string', checkpoint_interval=2, checkpoint_budget=600)
+        texts = {}
+        for _ in range(30):
+            h.insert('abcdef')
+            texts[h.version] = h.text
+
+        for version, text in texts.items():
+            self.assertEqual(text, h.text_at(version))
+        self.assertIn(len(h._checkpoints), range(1, 15))
+        for version, text in reversed(list(texts.items())):
+            self.assertEqual(text, h.text_at(version))
+
+    def test_text_at__lazy_checkpoints(self):
+        h = TextHistory(checkpoint_interval=10)
+        for index in range(55):
+            h.insert(str(index % 10))
+        self.assertEqual([], h._checkpoint_positions)
+
+        self.assertEqual('0123456789' * 3 + '012', h.text_at(33))
+        self.assertEqual([30], h._checkpoint_positions)
+        self.assertEqual('0123456789' * 3, h._checkpoints[30])
+
+        self.assertEqual('0123456789' * 4 + '01', h.text_at(42))
+        self.assertEqual([30, 40], h._checkpoint_positions)
+
     def test_get_actions__optimyze_1(self):
         h = TextHistory()
         h.insert('a')
         h.insert('b')
         h.delete(0, 1)
         h.delete(0, 1)
-        h.replace("abc")
-        actions = h.get_actions()
-        self.assertEqual(3, len(actions))
-        insert, delete, replace = actions
-        
-        self.assertIsInstance(insert, InsertAction)
+        self.assertEqual(1, len(h.get_actions(0, 4)))
+        delete, = h.get_actions(0, 4)
+
+        # вставка, удаленная целиком, остается пустым удалением на все версии
         self.assertIsInstance(delete, DeleteAction)
-        self.assertIsInstance(replace, ReplaceAction)
+        self.assertEqual(0, delete.from_version)
+        self.assertEqual(4, delete.to_version)
+        self.assertEqual(0, delete.length)
 
-        # insert
-        self.assertEqual(0, insert.from_version)
-        self.assertEqual(2, insert.to_version)
-        self.assertEqual("ab", insert.text)
+        h.replace("abc")
+        actions = h.get_actions()
+        self.assertEqual(1, len(actions))
+        replace, = actions
 
-        #delete
-        self.assertEqual(2, delete.from_version)
-        self.assertEqual(4, delete.to_version)
-        self.assertEqual(2, delete.length)
+        self.assertIsInstance(replace, ReplaceAction)
+        self.assertEqual(0, replace.from_version)
+        self.assertEqual(5, replace.to_version)
+        self.assertEqual("abc", replace.text)
 
     def test_get_actions__optimyze_2(self):
         h = TextHistory()
@@ -211,4 +264,228 @@ class TextHistoryTestCase(TestCase):
         
         self.assertEqual(0, insert.from_version)
         self.assertEqual(2, insert.to_version)
-        self.assertEqual("b", insert.text)
\ No newline at end of file
+        self.assertEqual("ba", insert.text)
+
+    def test_backend(self):
+        h = TextHistory(backend='string')
+        h.insert('abc')
+        h.replace('X', pos=1)
+        h.delete(pos=0, length=1)
+        self.assertEqual('Xc', h.text)
+
+        with self.assertRaises(ValueError):
+            TextHistory(backend='unknown')
+
+
+    def test_get_actions__first_action(self):
+        h = TextHistory()
+        h.insert('abc')
+        h.delete(0, 1)
+        self.assertEqual([(0, 1)], [(delete.pos, delete.length) for delete in h.get_actions(1)])
+
+        h.replace('x', pos=0)
+        replace, = h.get_actions(2)
+        self.assertEqual((0, 'x'), (replace.pos, replace.text))
+
+    def test_get_actions__backspace(self):
+        h = TextHistory()
+        h.insert('hello world')
+        for pos in range(10, 4, -1):
+            h.delete(pos, 1)
+        h.delete(5, 0)
+        h.delete(3, 2)
+
+        delete, = h.get_actions(1)
+        self.assertEqual((3, 8, 1, 9), (delete.pos, delete.length, delete.from_version, delete.to_version))
+        self.assertEqual('hel', h.text)
+
+    def test_get_actions__replace(self):
+        h = TextHistory()
+        h.insert('0123456789')
+        h.replace('ab', pos=2)
+        h.replace('cd', pos=4)
+        h.replace('X', pos=1)
+        h.replace('Y', pos=8)
+
+        replace, other = h.get_actions(1)
+        self.assertEqual((1, 'Xabcd'), (replace.pos, replace.text))
+        self.assertEqual((8, 'Y'), (other.pos, other.text))
+        self.assertEqual('0Xabcd67Y9', h.text)
+
+    def test_get_actions__typing(self):
+        h = TextHistory()
+        for index in range(5000):
+            h.insert('ab'[index % 2])
+        h.delete(4999, 1)
+        h.insert('X', pos=10)
+        h.replace('Y', pos=0)
+
+        insert, = h.get_actions()
+        self.assertIsInstance(insert.text, str)
+        self.assertEqual(h.text, insert.text)
+        self.assertEqual(5003, insert.to_version)
+
+    def test_get_actions__random(self):
+        rnd = random.Random(7)
+        for _ in range(200):
+            h = TextHistory(backend='string', checkpoint_interval=5)
+            pos = 0
+            for _ in range(rnd.randint(1, 40)):
+                # Правки кучкуются около курсора, как при наборе текста
+                pos = max(0, min(len(h.text), pos + rnd.randint(-2, 2)))
+                operation = rnd.choice(['insert', 'insert', 'delete', 'delete', 'replace'])
+                if operation == 'delete':
+                    h.delete(pos, rnd.randint(0, min(2, len(h.text) - pos)))
+                else:
+                    getattr(h, operation)(rnd.choice(['', 'a', 'bc']), pos=pos)
+
+            from_version = rnd.randint(0, h.version)
+            actions = h.get_actions(from_version)
+            self.assertLessEqual(len(actions), h.version - from_version)
+
+            text, version = h.text_at(from_version), from_version
+            for action in actions:
+                self.assertEqual(version, action.from_version)
+                text, version = action.apply(text, version), action.to_version
+            self.assertEqual(h.text, text)
+            self.assertEqual(h.version if actions else from_version, version)
+
+
+
+class RopeTestCase(TestCase):
+    def test_edits(self):
+        rnd = random.Random(42)
+        rope = Rope()
+        expected = StringText()
+        for _ in range(2000):
+            pos = rnd.randint(0, len(expected))
+            operation = rnd.choice(['insert', 'insert', 'replace', 'delete'])
+            if operation == 'delete':
+                length = rnd.randint(0, min(len(expected) - pos, 50))
+                rope.delete(pos, length)
+                expected.delete(pos, length)
+            else:
+                text = ''.join(rnd.choice('abc') for _ in range(rnd.choice([1, 3, 700])))
+                getattr(rope, operation)(pos, text)
+                getattr(expected, operation)(pos, text)
+            self.assertEqual(len(expected), len(rope))
+        self.assertEqual(str(expected), str(rope))
+
+    def test_typing_in_middle(self):
+        rope = Rope()
+        expected = StringText()
+        for index in range(20000):
+            rope.insert(index // 2, 'xy'[index % 2])
+            expected.insert(index // 2, 'xy'[index % 2])
+        self.assertEqual(str(expected), str(rope))
+        # Разрезанные куски сливаются обратно: узлов столько, сколько нужно тексту
+        self.assertLess(len(list(rope.chunks())), len(rope) // 64)
+
+    def test_chunks(self):
+        rope = Rope('x' * 1300)
+        self.assertEqual([512, 512, 276], [len(chunk) for chunk in rope.chunks()])
+
+        rope.insert(1300, 'y')
+        rope.insert(1301, 'z')
+        self.assertEqual(3, len(list(rope.chunks())))
+        self.assertEqual('x' * 1300 + 'yz', str(rope))
+
+
+class EncodingTestCase(TestCase):
+    @staticmethod
+    def fields(action):
+        return (type(action), action.from_version, action.to_version, action.pos,
+                action.length if isinstance(action, DeleteAction) else action.text)
+
+    def test_roundtrip(self):
+        actions = [InsertAction(0, 'привет, мир', 3, 4),
+                   ReplaceAction(300, 'x' * 200, 4, 1000),
+                   DeleteAction(2, 70000, 1005, 1006)]
+        data = b''.join(encode_actions(actions, 3))
+
+        self.assertEqual(1 + 1 + 1 + 1 + 1 + 20, len(actions[0].encode(3)))
+        self.assertEqual([self.fields(action) for action in actions],
+                         [self.fields(action) for action in decode_actions(data, 3)])
+
+        with self.assertRaises(ValueError):
+            decode_actions(data[:-1], 3)
+        with self.assertRaises(ValueError):
+            list(encode_actions(actions, 5))
+
+    def test_stream(self):
+        h = TextHistory()
+        h.insert('abc')
+        h.insert('ü', pos=1)
+        h.delete(0, 2)
+        h.replace('XY', pos=1)
+
+        data = b''.join(encode_actions(h.get_actions(1), 1))
+        decoder = ActionDecoder(1)
+        actions = []
+        for pos in range(len(data)):
+            actions.extend(decoder.feed(data[pos:pos + 1]))
+        self.assertEqual(0, decoder.pending)
+        self.assertEqual([self.fields(action) for action in h.get_actions(1)],
+                         [self.fields(action) for action in actions])
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            InsertAction(0, 'a', 0, 1).extra = 1
+
+    def test_history_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'history')
+
+        with TextHistory.open(path) as h:
+            h.insert('abc')
+            h.action(ReplaceAction(1, 'Ю', 1, 5))
+            h.delete(0, 1)
+
+        with TextHistory.open(path, backend='string') as h:
+            self.assertEqual('Юc', h.text)
+            self.assertEqual(6, h.version)
+            self.assertEqual('aЮc', h.text_at(5))
+            h.insert('!')
+
+        with open(path, 'ab') as file:
+            file.write(InsertAction(0, 'lost', 7, 8).encode(7)[:-2])
+
+        with TextHistory.open(path) as h:
+            self.assertEqual('Юc!', h.text)
+            self.assertEqual(7, h.version)
+            h.insert('?')
+
+        with TextHistory.open(path) as h:
+            self.assertEqual('Юc!?', h.text)
+
+    def test_history_file__checkpoints(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'history')
+
+        with TextHistory.open(path, file_checkpoint_interval=3) as h:
+            for index in range(7):
+                h.insert(str(index))
+            h.delete(0, 2)
+            texts = dict((version, h.text_at(version)) for version in range(h.version + 1))
+
+        with TextHistory.open(path) as h:
+            self.assertEqual('23456', h.text)
+            self.assertEqual(8, h.version)
+            self.assertEqual([6], h._checkpoint_positions)
+            self.assertEqual('012345', h._checkpoints[6])
+            for version, text in texts.items():
+                self.assertEqual(text, h.text_at(version))
+            self.assertEqual(8, len(h._actions))
+
+        with open(path, 'ab') as file:
+            file.write(encode_checkpoint(8, 'lost')[:-1])
+
+        with TextHistory.open(path) as h:
+            self.assertEqual('23456', h.text)
+            self.assertEqual([6], h._checkpoint_positions)
+            h.insert('!')
+
+        with TextHistory.open(path) as h:
+            self.assertEqual('23456!', h.text)
@@ -1,14 +1,91 @@
 from abc import ABCMeta, abstractmethod
+from bisect import bisect, insort
+from collections import OrderedDict
+import os
+import random
+import sys
+
 
 class TextHistory:
-    def __init__(self):
-        self._text = ''
+    def __init__(self, backend='rope', checkpoint_interval=1000, checkpoint_budget=4 * 2 ** 20):
+        if backend not in BACKENDS or checkpoint_interval < 1:
+            raise ValueError()
+
+        self._backend = BACKENDS[backend]
+        self._text = self._backend()
         self._version = 0
         self._actions = []
+        # Версия -> число действий до нее: версии растут, но не обязательно на 1
+        self._indexes = {0: 0}
+        # Число действий -> текст после них, от давно не читанных к недавним
+        self._checkpoints = OrderedDict()
+        self._checkpoint_positions = []
+        self._checkpoint_size = 0
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_budget = checkpoint_budget
+        self._file = None
+        self._file_checkpoint_interval = 0
+
+    @classmethod
+    def open(cls, path, file_checkpoint_interval=10000, **kwargs):
+        """
+            History stored in an append-only file.
+
+            Every new action is appended to the file as soon as it is applied,
+            every file_checkpoint_interval actions the full text is appended
+            too. On open only the actions after the last complete checkpoint
+            are replayed.
+        """
+        if file_checkpoint_interval < 1:
+            raise ValueError()
+
+        history = cls(**kwargs)
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                data = file.read()
+            if data and data[:len(HISTORY_MAGIC)] != HISTORY_MAGIC:
+                raise ValueError()
+
+            decoder = HistoryDecoder()
+            history._load(decoder.feed(data[len(HISTORY_MAGIC):]), decoder.checkpoint)
+            if decoder.pending:
+                # Недописанная при падении запись отбрасывается
+                os.truncate(path, len(data) - decoder.pending)
+
+        history._file_checkpoint_interval = file_checkpoint_interval
+        history._file = open(path, 'ab')
+        if not history._file.tell():
+            history._file.write(HISTORY_MAGIC)
+            history._file.flush()
+        return history
+
+    def _load(self, actions, checkpoint):
+        index, text = checkpoint
+        if index:
+            # Действия до контрольной точки только запоминаются: ее текст уже их результат
+            self._text = self._backend(text)
+            for action in actions[:index]:
+                self._actions.append(action)
+                self._indexes[action.to_version] = len(self._actions)
+            self._version = actions[index - 1].to_version
+            self._add_checkpoint(index, text)
+        for action in actions[index:]:
+            self.action(action)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def text(self):
-        return self._text
+        return str(self._text)
 
     @property
     def version(self):
@@ -16,14 +93,14 @@ class TextHistory:
 
     def insert(self, text, pos=None):
         if pos is None:
-            pos = len(self.text)
+            pos = len(self._text)
 
         action = InsertAction(pos, text, self.version, self.version + 1)
         return self.action(action)
 
     def replace(self, text, pos=None):
         if pos is None:
-            pos = len(self.text)
+            pos = len(self._text)
 
         action = ReplaceAction(pos, text, self.version, self.version + 1)
         return self.action(action)
@@ -33,11 +110,59 @@ class TextHistory:
         return self.action(action)
 
     def action(self, action):
-        self._text = action.apply(self.text, self.version)
-        self._version = action.to_version
+        action.apply_to(self._text, self.version)
+        self._version, version = action.to_version, self._version
         self._actions.append(action)
+        self._indexes[action.to_version] = len(self._actions)
+        if self._file is not None:
+            self._file.write(action.encode(version))
+            if len(self._actions) % self._file_checkpoint_interval == 0:
+                self._file.write(encode_checkpoint(len(self._actions), self.text))
+            self._file.flush()
         return self._version
 
+    def text_at(self, version):
+        """
+            Text as it was at the given version.
+
+            Replays actions from the nearest earlier checkpoint and keeps the
+            text at the last interval boundary it passes as a new checkpoint,
+            so later reads near that version replay at most one interval.
+        """
+        index = self._find_version_index(version)
+        if index == len(self._actions):
+            return self.text
+
+        position = bisect(self._checkpoint_positions, index)
+        start = self._checkpoint_positions[position - 1] if position else 0
+        text = ''
+        if start:
+            text = self._checkpoints[start]
+            self._checkpoints.move_to_end(start)
+
+        storage = self._backend(text)
+        boundary = index - index % self._checkpoint_interval
+        if boundary > start:
+            # Контрольные точки создаются лениво, только там, где историю читали
+            self._replay(storage, start, boundary)
+            self._add_checkpoint(boundary, str(storage))
+            start = boundary
+        self._replay(storage, start, index)
+        return str(storage)
+
+    def _replay(self, storage, start, end):
+        for action in self._actions[start:end]:
+            action.apply_to(storage, action.from_version)
+
+    def _add_checkpoint(self, index, text):
+        self._checkpoints[index] = text
+        insort(self._checkpoint_positions, index)
+        self._checkpoint_size += sys.getsizeof(text)
+        while self._checkpoint_size > self._checkpoint_budget:
+            index, text = self._checkpoints.popitem(last=False)
+            del self._checkpoint_positions[bisect(self._checkpoint_positions, index) - 1]
+            self._checkpoint_size -= sys.getsizeof(text)
+
     def get_actions(self, from_version=0, to_version=None):
         if to_version is None:
             to_version = self.version
@@ -56,27 +181,39 @@ class TextHistory:
         return self._optimize(self._actions[start_pos:end_pos])
 
     def _find_version_index(self, version):
-        for index, action in enumerate(self._actions):
-            if action.from_version == version:
-                return index
-            elif action.to_version == version:
-                return index + 1
-        raise ValueError()
+        if version not in self._indexes:
+            raise ValueError()
+        return self._indexes[version]
 
 
     @staticmethod
     def _optimize(actions):
+        # Один проход: действие сливается с последним из результата, а слитое - дальше с
+        # предыдущими, поэтому каждое действие сливается и удаляется не больше одного раза
         new_list = []
         for action in actions:
-            if not new_list:
-                new_list.append(action)
-            tmp = new_list.pop()
-            new_list.extend(action.optimize(tmp))
+            while new_list:
+                merged = TextHistory._merge(new_list[-1], action)
+                if merged is None:
+                    break
+                new_list.pop()
+                action = merged
+            new_list.append(action)
         return new_list
 
+    @staticmethod
+    def _merge(action, next_action):
+        # Пустое действие только сдвигает версию: его поглощает соседнее
+        if next_action.empty:
+            return action.with_versions(action.from_version, next_action.to_version)
+        if action.empty:
+            return next_action.with_versions(action.from_version, next_action.to_version)
+        return next_action.optimize(action)
 
 
 class Action(metaclass=ABCMeta):
+    __slots__ = ('_from_version', '_to_version')
+
     def __init__(self, from_version, to_version):
         self._from_version = from_version
         self._to_version = to_version
@@ -92,6 +229,10 @@ class Action(metaclass=ABCMeta):
     def apply(self, text, version):
         pass
 
+    @abstractmethod
+    def apply_to(self, storage, version):
+        pass
+
     def _check_version(self, version):
         if version != self.from_version:
             return False
@@ -101,20 +242,54 @@ class Action(metaclass=ABCMeta):
 
         return True
 
+    @property
+    @abstractmethod
+    def empty(self):
+        pass
+
+    def encode(self, version=0):
+        """
+            Binary record of the action.
+
+            Versions are stored as deltas from the version the previous record
+            ended at, so a contiguous history spends one byte on from_version.
+        """
+        return b''.join((bytes([self.KIND]),
+                         encode_varint(self.from_version - version),
+                         encode_varint(self.to_version - self.from_version),
+                         encode_varint(self.pos),
+                         self._encode_body()))
+
+    @abstractmethod
+    def _encode_body(self):
+        pass
+
+    @abstractmethod
+    def with_versions(self, from_version, to_version):
+        pass
+
+    @staticmethod
+    def _storage(text):
+        # Слияния правят общий текст на месте: строка собирается один раз, когда читают text
+        return text if isinstance(text, MergedText) else MergedText(text)
+
     def optimize_with_insert_action(self, other_action):
-        return [self, other_action]
+        return None
 
     def optimize_with_delete_action(self, other_action):
-        return [self, other_action]
+        return None
 
     def optimize_with_replace_action(self, other_action):
-        return [self, other_action]
+        return None
 
     @abstractmethod
     def optimize(self, other_action):
         pass
 
 class InsertAction(Action):
+    __slots__ = ('_text', '_pos')
+    KIND = 1
+
     def __init__(self, pos, text, from_version, to_version):
         super().__init__(from_version, to_version)
         self._text = text
@@ -122,6 +297,8 @@ class InsertAction(Action):
 
     @property
     def text(self):
+        if not isinstance(self._text, str):
+            self._text = str(self._text)
         return self._text
 
     @property
@@ -132,7 +309,13 @@ class InsertAction(Action):
         if not self._check_version(version):
             raise ValueError()
 
-        return self._insert(text, self._pos, self._text)
+        return self._insert(text, self._pos, self.text)
+
+    def apply_to(self, storage, version):
+        if not self._check_version(version) or self._pos > len(storage) or self._pos < 0:
+            raise ValueError()
+
+        storage.insert(self._pos, self.text)
 
     @staticmethod
     def _insert(old_str, pos, ins_str):
@@ -141,28 +324,65 @@ class InsertAction(Action):
 
         return ins_str.join([old_str[:pos], old_str[pos:]])
 
+    @property
+    def empty(self):
+        return not len(self._text)
+
+    def with_versions(self, from_version, to_version):
+        return InsertAction(self.pos, self._text, from_version, to_version)
+
+    def _encode_body(self):
+        data = self.text.encode()
+        return encode_varint(len(data)) + data
+
     def optimize_with_insert_action(self, other_action):
-        if self.pos == other_action.pos:
-            action = InsertAction(other_action.pos,
-                                  other_action.text,
-                                  self.from_version,
-                                  other_action.to_version)
-            return [action]
-
-        elif other_action.pos - (self.pos + len(self.text)) == 0:
-            action = InsertAction(self.pos,
-                                  self.text + other_action.text,
-                                  self.from_version,
-                                  other_action.to_version)
-            return [action]
-
-        return [self, other_action]
+        # Вставка внутрь или на край только что вставленного текста
+        offset = other_action.pos - self.pos
+        if 0 <= offset <= len(self._text):
+            text = self._storage(self._text)
+            text.insert(offset, other_action.text)
+            return InsertAction(self.pos, text, self.from_version, other_action.to_version)
+
+        return None
+
+    def optimize_with_delete_action(self, other_action):
+        start = other_action.pos - self.pos
+        end = start + other_action.length
+        if 0 <= start and end <= len(self._text):
+            # Удалена часть вставленного текста, пустая вставка остается пустым удалением
+            if end - start == len(self._text):
+                return DeleteAction(self.pos, 0, self.from_version, other_action.to_version)
+            text = self._storage(self._text)
+            text.delete(start, other_action.length)
+            return InsertAction(self.pos, text, self.from_version, other_action.to_version)
+
+        if start <= 0 and end >= len(self._text):
+            # Вставленный текст удален целиком вместе с соседним
+            return DeleteAction(other_action.pos,
+                                other_action.length - len(self._text),
+                                self.from_version,
+                                other_action.to_version)
+
+        return None
+
+    def optimize_with_replace_action(self, other_action):
+        start = other_action.pos - self.pos
+        end = start + len(other_action._text)
+        if 0 <= start and end <= len(self._text):
+            text = self._storage(self._text)
+            text.replace(start, other_action.text)
+            return InsertAction(self.pos, text, self.from_version, other_action.to_version)
+
+        return None
 
     def optimize(self, other_action):
         return other_action.optimize_with_insert_action(self)
 
 
 class ReplaceAction(Action):
+    __slots__ = ('_pos', '_text')
+    KIND = 2
+
     def __init__(self, pos, text, from_version, to_version):
         super().__init__(from_version, to_version)
         self._pos = pos
@@ -170,6 +390,8 @@ class ReplaceAction(Action):
 
     @property
     def text(self):
+        if not isinstance(self._text, str):
+            self._text = str(self._text)
         return self._text
 
     @property
@@ -180,7 +402,13 @@ class ReplaceAction(Action):
         if not self._check_version(version):
             raise ValueError()
 
-        return self._replace(text, self._pos, self._text)
+        return self._replace(text, self._pos, self.text)
+
+    def apply_to(self, storage, version):
+        if not self._check_version(version) or self._pos > len(storage) or self._pos < 0:
+            raise ValueError()
+
+        storage.replace(self._pos, self.text)
 
     @staticmethod
     def _replace(old_str, pos, ins_str):
@@ -192,10 +420,41 @@ class ReplaceAction(Action):
         else:
             return old_str[:pos] + ins_str + old_str[pos + len(ins_str):]
 
+    @property
+    def empty(self):
+        return not len(self._text)
+
+    def with_versions(self, from_version, to_version):
+        return ReplaceAction(self.pos, self._text, from_version, to_version)
+
+    def _encode_body(self):
+        data = self.text.encode()
+        return encode_varint(len(data)) + data
+
+    def optimize_with_replace_action(self, other_action):
+        # Замены, которые пересекаются или стыкуются, пишут один общий кусок
+        offset = other_action.pos - self.pos
+        if offset > len(self._text) or -offset > len(other_action._text):
+            return None
+
+        text = self._storage(self._text)
+        if offset >= 0:
+            text.replace(offset, other_action.text)
+        else:
+            text.delete(0, min(offset + len(other_action._text), len(text)))
+            text.insert(0, other_action.text)
+        return ReplaceAction(min(self.pos, other_action.pos),
+                             text,
+                             self.from_version,
+                             other_action.to_version)
+
     def optimize(self, other_action):
         return other_action.optimize_with_replace_action(self)
 
 class DeleteAction(Action):
+    __slots__ = ('_pos', '_length')
+    KIND = 3
+
     def __init__(self, pos, length, from_version, to_version):
         super().__init__(from_version, to_version)
         self._pos = pos
@@ -215,9 +474,21 @@ class DeleteAction(Action):
 
         return self._delete(text, self._pos, self._length)
 
+    def apply_to(self, storage, version):
+        if not self._check_version(version):
+            raise ValueError()
+
+        if self._pos > len(storage) or self._pos < 0 or self._length < 0:
+            raise ValueError()
+
+        if self._pos + self._length > len(storage):
+            raise ValueError()
+
+        storage.delete(self._pos, self._length)
+
     @staticmethod
     def _delete(text, pos, length):
-        if pos > len(text) or pos < 0:
+        if pos > len(text) or pos < 0 or length < 0:
             raise ValueError()
 
         if pos + length > len(text):
@@ -225,15 +496,415 @@ class DeleteAction(Action):
 
         return text[:pos] + text[pos + length:]
 
+    @property
+    def empty(self):
+        return not self._length
+
+    def with_versions(self, from_version, to_version):
+        return DeleteAction(self.pos, self.length, from_version, to_version)
+
+    def _encode_body(self):
+        return encode_varint(self.length)
+
     def optimize_with_delete_action(self, other_action):
-        if other_action.pos == self.pos:
-            action = DeleteAction(other_action.pos,
-                                  other_action.length + self.length,
-                                  self.from_version,
-                                  other_action.to_version)
-            return [action]
+        # Удаление вперед (delete) с той же позиции и назад (backspace) до нее
+        if other_action.pos <= self.pos <= other_action.pos + other_action.length:
+            return DeleteAction(other_action.pos,
+                                other_action.length + self.length,
+                                self.from_version,
+                                other_action.to_version)
 
-        return [self, other_action]
+        return None
 
     def optimize(self, other_action):
         return other_action.optimize_with_delete_action(self)
+
+
+def encode_varint(value):
+    if value < 0:
+        raise ValueError()
+
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(buffer, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_actions(actions, version=0):
+    """
+        Binary records of the actions, one bytes object per action.
+
+        version is the version the first action starts from, as in
+        get_actions(version).
+    """
+    for action in actions:
+        yield action.encode(version)
+        version = action.to_version
+
+
+class ActionDecoder:
+    """
+        Incremental decoder of encode_actions output.
+
+        Data may be fed in chunks of any size; a record split between chunks
+        is kept until the rest of it arrives.
+    """
+
+    def __init__(self, version=0):
+        self._buffer = b''
+        self._version = version
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        buffer = self._buffer + data if self._buffer else bytes(data)
+        actions = []
+        pos = 0
+        while pos < len(buffer):
+            try:
+                action, end = self._decode(buffer, pos)
+            except IndexError:
+                break
+            if action is not None:
+                actions.append(action)
+            pos = end
+        self._buffer = buffer[pos:]
+        return actions
+
+    def _decode(self, buffer, pos):
+        kind = buffer[pos]
+        if kind not in ACTIONS:
+            raise ValueError()
+
+        delta, pos = decode_varint(buffer, pos + 1)
+        steps, pos = decode_varint(buffer, pos)
+        action_pos, pos = decode_varint(buffer, pos)
+        value, pos = decode_varint(buffer, pos)
+        if kind != DeleteAction.KIND:
+            if pos + value > len(buffer):
+                raise IndexError()
+            value, pos = buffer[pos:pos + value].decode(), pos + value
+
+        from_version = self._version + delta
+        self._version = from_version + steps
+        return ACTIONS[kind](action_pos, value, from_version, self._version), pos
+
+
+class HistoryDecoder(ActionDecoder):
+    """
+        Decoder of a history file: actions and full text checkpoints.
+
+        checkpoint is the number of actions and the text after them from the
+        last complete checkpoint record, (0, '') if there was none.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.checkpoint = (0, '')
+        self._count = 0
+
+    def _decode(self, buffer, pos):
+        if buffer[pos] != CHECKPOINT_KIND:
+            action, pos = super()._decode(buffer, pos)
+            self._count += 1
+            return action, pos
+
+        # Число действий в записи только для проверки: точка идет сразу за своим действием
+        index, pos = decode_varint(buffer, pos + 1)
+        length, pos = decode_varint(buffer, pos)
+        if pos + length > len(buffer):
+            raise IndexError()
+        if index != self._count:
+            raise ValueError()
+        self.checkpoint = (index, buffer[pos:pos + length].decode())
+        return None, pos + length
+
+
+def encode_checkpoint(index, text):
+    """
+        History file record with the text after the first index actions.
+    """
+    data = text.encode()
+    return b''.join((bytes([CHECKPOINT_KIND]), encode_varint(index), encode_varint(len(data)), data))
+
+
+def decode_actions(data, version=0):
+    decoder = ActionDecoder(version)
+    actions = decoder.feed(data)
+    if decoder.pending:
+        raise ValueError()
+    return actions
+
+
+class StringText:
+    """
+        Text kept as one string: every edit copies the whole document.
+    """
+
+    def __init__(self, text=''):
+        self._text = text
+
+    def __len__(self):
+        return len(self._text)
+
+    def __str__(self):
+        return self._text
+
+    def insert(self, pos, text):
+        self._text = InsertAction._insert(self._text, pos, text)
+
+    def replace(self, pos, text):
+        self._text = ReplaceAction._replace(self._text, pos, text)
+
+    def delete(self, pos, length):
+        self._text = DeleteAction._delete(self._text, pos, length)
+
+
+class MergedText:
+    """
+        Text of an action that absorbs later edits while actions are merged.
+
+        Typing at the end only collects pieces; other edits go to a rope, so
+        a run of merges costs the size of the text instead of its square.
+    """
+
+    def __init__(self, text):
+        self._rope = Rope(text)
+        self._pieces = []
+        self._length = len(text)
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        self._flush()
+        return str(self._rope)
+
+    def insert(self, pos, text):
+        if pos == self._length:
+            self._pieces.append(text)
+        else:
+            self._flush()
+            self._rope.insert(pos, text)
+        self._length += len(text)
+
+    def replace(self, pos, text):
+        self._flush()
+        self._rope.replace(pos, text)
+        self._length = len(self._rope)
+
+    def delete(self, pos, length):
+        self._flush()
+        self._rope.delete(pos, length)
+        self._length = len(self._rope)
+
+    def _flush(self):
+        if self._pieces:
+            self._rope.insert(len(self._rope), ''.join(self._pieces))
+            self._pieces = []
+
+
+class RopeNode:
+    __slots__ = ('text', 'size', 'priority', 'left', 'right')
+
+    def __init__(self, text):
+        self.text = text
+        self.size = len(text)
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+
+    def update(self):
+        self.size = len(self.text)
+        if self.left is not None:
+            self.size += self.left.size
+        if self.right is not None:
+            self.size += self.right.size
+
+
+class Rope:
+    """
+        Text as an implicit treap of chunks ordered by position.
+
+        Edits split and merge the treap in O(log n) instead of copying the
+        whole document; the flat string is built on demand and cached.
+    """
+
+    chunk_size = 512
+
+    def __init__(self, text=''):
+        self._root = None
+        self._text = ''
+        self.insert(0, text)
+
+    def __len__(self):
+        return 0 if self._root is None else self._root.size
+
+    def __str__(self):
+        if self._text is None:
+            self._text = ''.join(self.chunks())
+        return self._text
+
+    def chunks(self):
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                yield node.text
+                node = node.right
+
+    def insert(self, pos, text):
+        if not text:
+            return
+
+        self._cut(pos)
+        left, right = self._split(self._root, pos)
+        if left is not None and len(self._last(left).text) + len(text) <= Rope.chunk_size:
+            # Ввод по символу дописывается в последний кусок, а не плодит узлы
+            self._append(left, text)
+        else:
+            for start in range(0, len(text), Rope.chunk_size):
+                left = self._merge(left, RopeNode(text[start:start + Rope.chunk_size]))
+        self._root = self._join(left, right)
+        self._text = None
+
+    def replace(self, pos, text):
+        self.delete(pos, min(len(text), len(self) - pos))
+        self.insert(pos, text)
+
+    def delete(self, pos, length):
+        if not length:
+            return
+
+        self._cut(pos)
+        self._cut(pos + length)
+        left, right = self._split(self._root, pos)
+        _, right = self._split(right, length)
+        self._root = self._join(left, right)
+        self._text = None
+
+    def _cut(self, pos):
+        # Граница куска в pos: хвост куска вставляется отдельным узлом со своим приоритетом
+        node = self._root
+        path = []
+        while node is not None:
+            path.append(node)
+            left_size = 0 if node.left is None else node.left.size
+            if pos <= left_size:
+                node = node.left
+            elif pos - left_size >= len(node.text):
+                pos -= left_size + len(node.text)
+                node = node.right
+            else:
+                break
+        else:
+            return
+
+        offset = pos - (0 if node.left is None else node.left.size)
+        tail = node.text[offset:]
+        node.text = node.text[:offset]
+        for parent in path:
+            parent.size -= len(tail)
+
+        boundary = self._position(path)
+        left, right = self._split(self._root, boundary)
+        self._root = self._merge(self._merge(left, RopeNode(tail)), right)
+
+    @staticmethod
+    def _position(path):
+        # Позиция конца последнего узла пути от начала текста
+        pos = 0
+        for parent, child in zip(path, path[1:]):
+            if child is parent.right:
+                pos += parent.size - child.size
+        node = path[-1]
+        return pos + node.size - (0 if node.right is None else node.right.size)
+
+    @staticmethod
+    def _join(left, right):
+        # Куски по краям правки сливаются, если помещаются в один: иначе каждый разрез
+        # внутри куска оставлял бы лишний узел
+        if left is not None and right is not None:
+            text = Rope._first(right).text
+            if len(Rope._last(left).text) + len(text) <= Rope.chunk_size:
+                _, right = Rope._split(right, len(text))
+                Rope._append(left, text)
+        return Rope._merge(left, right)
+
+    @staticmethod
+    def _first(node):
+        while node.left is not None:
+            node = node.left
+        return node
+
+    @staticmethod
+    def _last(node):
+        while node.right is not None:
+            node = node.right
+        return node
+
+    @staticmethod
+    def _append(node, text):
+        while node.right is not None:
+            node.size += len(text)
+            node = node.right
+        node.text += text
+        node.size += len(text)
+
+    @staticmethod
+    def _split(node, pos):
+        if node is None:
+            return None, None
+
+        left_size = 0 if node.left is None else node.left.size
+        if pos <= left_size:
+            left, node.left = Rope._split(node.left, pos)
+            node.update()
+            return left, node
+
+        # Позиция всегда на границе куска, см. _cut
+        node.right, right = Rope._split(node.right, pos - left_size - len(node.text))
+        node.update()
+        return node, right
+
+    @staticmethod
+    def _merge(left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+
+        if left.priority > right.priority:
+            left.right = Rope._merge(left.right, right)
+            left.update()
+            return left
+
+        right.left = Rope._merge(left, right.left)
+        right.update()
+        return right
+
+
+BACKENDS = {'rope': Rope, 'string': StringText}
+ACTIONS = {action.KIND: action for action in (InsertAction, ReplaceAction, DeleteAction)}
+CHECKPOINT_KIND = 0
+HISTORY_MAGIC = b'TXTH\x01'